@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""\
+time perch on synthetic stage graphs
+
+    python benchmarks/bench_graph.py --shape diamond --stages 8 --objects 5000
+
+builds a directory of stages shaped like a chain, a wide fan-out or a
+diamond, then reports how long Graph construction, Stage.configuration and
+Stage.process take, how many objects per second make it through, and the
+peak RSS of perch and of the stages it ran.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from textwrap import dedent
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from perch.cache import ConfigCache
+from perch.executor import Executor
+from perch.router import Graph, Stage
+
+
+def content(name, intags, outtags):
+    "an echoing stage, like the ones in tests/test_router.py"
+    return dedent("""
+        #!/usr/bin/env python
+        from perch.bases import Collector
+
+        class Echo(Collector):
+            name = %r
+            input_tags = %r
+            output_tags = %r
+
+            def parse(self, obj):
+                return obj
+
+        Echo().run()
+    """ % (name, intags, outtags)).strip()
+
+
+def chain(n):
+    "src -> s0 -> s1 -> ... -> s(n-1)"
+    return [
+        ('s%d' % i, ['src' if i == 0 else 't%d' % (i - 1)], ['t%d' % i])
+        for i in range(n)
+    ]
+
+
+def fanout(n):
+    "one root, with every other stage consuming its output"
+    return [('root', ['src'], ['root'])] + [
+        ('leaf%d' % i, ['root'], ['leaf%d' % i]) for i in range(n - 1)
+    ]
+
+
+def diamond(n):
+    "one root, n - 2 stages in the middle, and one stage joining them"
+    middle = ['mid%d' % i for i in range(max(n - 2, 1))]
+    return [('root', ['src'], ['root'])] + [
+        (name, ['root'], [name]) for name in middle
+    ] + [('join', middle, ['join'])]
+
+
+shapes = {'chain': chain, 'fanout': fanout, 'diamond': diamond}
+
+
+def make_stages(directory, shape, n):
+    for name, intags, outtags in shapes[shape](n):
+        with open(os.path.join(directory, '%s.py' % name), 'w') as f:
+            f.write(content(name, intags, outtags))
+
+
+def objects(count, size):
+    return [
+        {'filename': 'page%d.html' % i, 'content': 'x' * size}
+        for i in range(count)
+    ]
+
+
+def configured(directory, **options):
+    "a Graph with every stage's configuration read, which it does lazily"
+    graph = Graph(directory, **options)
+    graph.configure()
+    return graph
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+def peak_rss():
+    "peak RSS in kilobytes of this process and of its largest child"
+    scale = 1024 if sys.platform == 'darwin' else 1  # bytes on OS X
+    return {
+        'self_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+    }
+
+
+def bench(args):
+    directory = tempfile.mkdtemp(prefix='perch-bench-')
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]
+    )
+    options = {'persistent': args.persistent, 'formats': args.serializer}
+    results = {'shape': args.shape, 'stages': args.stages,
+               'objects': args.objects, 'payload': args.payload}
+
+    try:
+        stagedir = os.path.join(directory, 'stages')
+        os.mkdir(stagedir)
+        make_stages(stagedir, args.shape, args.stages)
+        cache = ConfigCache(os.path.join(directory, 'cache'))
+
+        # Graph construction: cold, then with a warm configuration cache
+        results['graph_cold_s'], graph = timed(
+            configured, stagedir, cache=cache, **options
+        )
+        graph.close()
+        results['graph_warm_s'], graph = timed(
+            configured, stagedir, cache=cache, **options
+        )
+
+        # startup overhead, from probing a single stage's configuration
+        probes = [
+            timed(lambda: Stage(stage.pathfile).configuration)[0]
+            for stage in graph.stages
+        ]
+        results['startup_per_stage_s'] = sum(probes) / len(probes)
+
+        # one stage on its own
+        objs = objects(args.objects, args.payload)
+        stage = graph.stages[0]
+        elapsed, out = timed(stage.process, objs)
+        results['process_s'] = elapsed
+        results['process_objects_per_s'] = len(objs) / elapsed
+
+        # the whole graph
+        elapsed, out = timed(Executor(graph, jobs=args.jobs).run, {'src': objs})
+        total = sum(len(o) for o in out.values())
+        results['graph_s'] = elapsed
+        results['graph_objects_per_s'] = total / elapsed
+
+        graph.close()
+        results.update(peak_rss())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def report(results):
+    width = max(len(k) for k in results)
+    for key in sorted(results):
+        value = results[key]
+        if isinstance(value, float):
+            value = '%.4f' % value
+
+        print('%s  %s' % (key.ljust(width), value))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--shape', choices=sorted(shapes), default='chain')
+    p.add_argument('--stages', type=int, default=4)
+    p.add_argument('--objects', type=int, default=1000)
+    p.add_argument('--payload', type=int, default=1024,
+                   help='bytes of content per object')
+    p.add_argument('--jobs', type=int, default=1)
+    p.add_argument('--persistent', action='store_true')
+    p.add_argument('--serializer', action='append')
+    p.add_argument('--json', action='store_true',
+                   help='print results as JSON, to compare runs')
+    args = p.parse_args(argv)
+
+    results = bench(args)
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""\
+run stages with asyncio instead of a thread per stage, so a single thread
+can keep dozens of stage processes busy at once. Needs Python 3.5 or later;
+nothing else in perch imports this module.
+"""
+import asyncio
+from collections import deque
+from subprocess import PIPE
+
+from .config import constants
+from .errors import BadExit, BadRunner
+from .executor import Executor
+from .framing import LengthFraming, framings
+from .profile import Record
+from .serializers import serializers
+
+
+async def read(framing, reader):
+    "read one payload from an asyncio StreamReader, or None at the end"
+    if isinstance(framing, LengthFraming):
+        try:
+            header = await reader.readexactly(framing.header.size)
+            size, = framing.header.unpack(header)
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+
+    line = b''
+    while True:
+        try:
+            line += await reader.readuntil(b'\n')
+            return line[:-1]
+        except asyncio.LimitOverrunError as e:
+            # a line longer than the reader's buffer; take what's there
+            line += await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError as e:
+            line += e.partial
+            return line or None
+
+
+async def payloads(framing, reader):
+    "yield payloads until the stream ends, skipping empty ones"
+    while True:
+        payload = await read(framing, reader)
+        if payload is None:
+            return
+
+        if not framing.is_empty(payload):
+            yield payload
+
+
+async def feed(pipe, frames):
+    "write frames to a pipe, waiting for the process to keep up as we go"
+    try:
+        if hasattr(frames, '__aiter__'):
+            async for frame in frames:
+                pipe.write(frame)
+                await pipe.drain()
+        else:
+            for frame in frames:
+                pipe.write(frame)
+                await pipe.drain()
+
+    except (BrokenPipeError, ConnectionResetError):
+        return  # the process went away; whoever reads from it reports it
+
+    finally:
+        pipe.close()
+
+
+async def tail(reader, lines=100):
+    "keep a process's stderr drained, returning the last few lines"
+    kept = deque(maxlen=lines)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return b''.join(kept).decode('utf-8', 'replace')
+
+        kept.append(line)
+
+
+async def spill(stage, objs, serializer):
+    "Stage.frames, for an async iterable of objects"
+    framing = framings[serializer.framing]()
+    async for obj in objs:
+        if stage.spool is not None:
+            obj = stage.spool.spill(obj)
+
+        yield framing.frame(serializer.dump_bytes(obj))
+
+
+class AsyncStage(object):
+    """\
+    run a Stage's commands as asyncio subprocesses. Each command gets its
+    own process; persistent workers and batching are left to Stage.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __repr__(self):
+        return 'AsyncStage(%r)' % self.stage
+
+    @property
+    def configuration(self):
+        return self.stage.configuration
+
+    async def configure(self):
+        "read the stage's configuration without blocking, if we don't have it"
+        stage = self.stage
+        if not getattr(stage, '_configuration', None):
+            cached = stage.cache.get(stage) if stage.cache is not None else None
+            if cached is None:
+                # negotiation needs this, so it's always in the default
+                cached = (await self.request(
+                    'config',
+                    serializer=serializers[constants.default_serializer](),
+                ))[0]
+
+                if stage.cache is not None:
+                    stage.cache.set(stage, cached)
+
+            stage._configuration = cached
+
+        return stage._configuration
+
+    async def stream(self, cmd, objs=(), serializer=None):
+        """\
+        run a command against the stage, feeding it objs (a list or an async
+        iterable) and yielding output objects as their frames arrive
+        """
+        stage = self.stage
+        serializer = serializer or stage.serializer
+        record = Record(stage.label, cmd)
+        if hasattr(objs, '__aiter__'):
+            frames = spill(stage, objs, serializer)
+        else:
+            frames = stage.frames(objs, serializer)
+            if stage.profile is not None:
+                frames = record.count_in(frames)
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *stage.command(cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                env=stage.env(serializer)
+            )
+        except OSError:
+            raise BadRunner('No such file or directory: %s' % stage.runner)
+
+        record.spawn()
+        stderr = asyncio.ensure_future(tail(process.stderr))
+        feeder = asyncio.ensure_future(feed(process.stdin, frames))
+
+        framing = framings[serializer.framing]()
+        finished = False
+        try:
+            async for payload in payloads(framing, process.stdout):
+                record.output(payload)
+                yield stage.load(serializer, payload)
+
+            finished = True
+        finally:
+            # stop the process if our consumer gave up early
+            if not finished:
+                feeder.cancel()
+                stderr.cancel()
+                process.kill()
+                await process.wait()
+
+        await feeder
+        await process.wait()
+        stderr = await stderr
+        record.finish(stderr=stderr)
+        stage.submit(record)
+        if process.returncode != 0:
+            raise BadExit('Response code %s. Stderr:\n\n%s' % (
+                process.returncode, stderr
+            ))
+
+    async def request(self, cmd, objs=(), serializer=None):
+        "run a command against the stage, returning all of its output"
+        return [obj async for obj in self.stream(cmd, objs, serializer)]
+
+    async def process(self, objs):
+        return await self.request('process', objs)
+
+
+class AsyncExecutor(Executor):
+    """\
+    run a Graph like Executor does, but on an asyncio event loop: every
+    stage's configuration is read at once, and up to `jobs` stages run at
+    a time without a thread each. `run` is a coroutine.
+    """
+    def __init__(self, graph, jobs=64):
+        Executor.__init__(self, graph, jobs)
+        self.stages = dict((stage, AsyncStage(stage)) for stage in graph.stages)
+
+    async def execute(self, stage, objs):
+        "run a single stage; stages without input tags are asked to start"
+        if not stage.configuration['input_tags']:
+            return await self.stages[stage].request('start')
+
+        return await self.stages[stage].process(objs)
+
+    async def run(self, initial=None):
+        """\
+        run the whole graph, returning a dict of stage name to output. Seed
+        objects can be passed in `initial`, as a dict of tag to objects.
+
+        If any stage fails, no new stages are started; the ones already
+        running are allowed to finish and the first error is raised.
+        """
+        await asyncio.gather(*(s.configure() for s in self.stages.values()))
+
+        initial = initial or {}
+        outputs = {}
+        inbox = {}
+        errors = []
+        tasks = {}
+        limit = asyncio.Semaphore(self.jobs)
+
+        async def work(stage):
+            producers = [tasks[producer] for producer in self.dependencies[stage]]
+            if producers:
+                await asyncio.wait(producers)
+
+            async with limit:
+                if errors:
+                    return
+
+                try:
+                    out = await self.execute(
+                        stage, self.inputs(stage, initial, inbox)
+                    )
+                    routed = self.router.dispatch(stage, out)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+            outputs[stage] = out
+            for consumer, objs in routed.items():
+                inbox.setdefault(consumer, {})[stage] = objs
+
+        # in order, so every stage's producers have their tasks first
+        for stage in self.order():
+            tasks[stage] = asyncio.ensure_future(work(stage))
+
+        await asyncio.gather(*tasks.values())
+
+        if errors:
+            raise errors[0]
+
+        return dict(
+            (stage.configuration['name'], out)
+            for stage, out in outputs.items()
+        )
@@ -1,56 +1,313 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import json
+import multiprocessing
 import os
 import sys
+from threading import Event, Lock, Thread
+import time
 
+from .cache import RenderCache
 from .config import constants
+from .framing import framings
 from .serializers import serializers
+from .sorting import ExternalSort
+from .spool import Spool, plain
+
+
+class RequestBody(object):
+    """\
+    the payloads of one framed request, read up to the empty payload that
+    ends it
+    """
+    def __init__(self, framing, in_file):
+        self.framing = framing
+        self.in_file = in_file
+        self.done = False
+
+    def __iter__(self):
+        if self.done:
+            return
+
+        for payload in self.framing.frames(self.in_file):
+            yield payload
+
+        self.done = True
+
+    def readlines(self):
+        return list(self)
+
+    def drain(self):
+        "skip whatever the handler didn't read, so the next request lines up"
+        for _ in self:
+            pass
+
+
+class FrameWriter(object):
+    """\
+    gather frames and write them out in big chunks, so a handler putting out
+    lots of small objects makes a few large writes instead of one per object.
+
+    Frames don't wait much longer than `interval` seconds to be flushed:
+    writes flush once the oldest unflushed frame is that old, and once
+    `start`ed, a background thread does the same while the handler is busy
+    elsewhere (waiting for its next input, say).
+    """
+    def __init__(self, out_file, size=None, interval=None):
+        self.out_file = out_file
+        self.size = size or constants.output_buffer_size
+        self.interval = constants.flush_interval if interval is None else interval
+        self.pending = []
+        self.pending_bytes = 0
+        self.since = None  # when the oldest unflushed frame came in
+        self.lock = Lock()
+        self.stopped = Event()
+        self.flusher = None
+
+    def write(self, frame):
+        with self.lock:
+            self.pending.append(frame)
+            self.pending_bytes += len(frame)
+            if self.pending_bytes >= self.size:
+                self._drain()
+
+            now = time.time()
+            if self.since is None:
+                self.since = now
+
+            if now - self.since >= self.interval:
+                self._flush()
+
+    def _drain(self):
+        if self.pending:
+            self.out_file.write(b''.join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+
+    def _flush(self):
+        self._drain()
+        self.out_file.flush()
+        self.since = None
+
+    def drain(self):
+        "hand everything pending to the file, without flushing it"
+        with self.lock:
+            self._drain()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def flush_stale(self):
+        "flush if the oldest unflushed frame has waited `interval` seconds"
+        with self.lock:
+            if self.since is not None and time.time() - self.since >= self.interval:
+                self._flush()
+
+    def start(self):
+        "keep flushing stale frames from a background thread until `close`"
+        if self.interval > 0 and self.flusher is None:
+            self.flusher = Thread(target=self._flush_until_stopped)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def _flush_until_stopped(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.flush_stale()
+        except (IOError, OSError):
+            pass  # the reader went away; the next write says so
+
+    def close(self):
+        "stop flushing in the background, and hand over what's pending"
+        if self.flusher is not None:
+            self.stopped.set()
+            self.flusher.join()
+            self.flusher = None
+
+        self.drain()
 
 
 class StdIOHandler(object):
     "Provide common I/O handling to the command line"
+    commands = ['config', 'process', 'start', 'serve']
+    output_buffer_size = None  # bytes per write; None for the default
+    dependencies = []  # files read while working (templates, say)
+
     def __init__(self):
         self.config = json.loads(os.environ.get(constants.stage_env_var, '{}'))
         self.serializer = serializers.get(self.config.get(
             constants.serializer_key, constants.default_serializer
         ))()
+        self.framing = framings[self.serializer.framing]()
 
-    def get_configuration(self):
-        return self.serializer.dump({
+        spool = self.config.get(constants.spool_key)
+        self.spool = Spool(**spool) if spool else None
+
+    def configuration(self):
+        return {
             'name': self.name,
             'input_tags': self.input_tags,
             'output_tags': self.output_tags,
-        })
+            'commands': self.commands,
+            'aggregates': callable(getattr(self, 'final', None)),
+            'serializers': self.serializers(),
+            'dependencies': list(self.dependencies),
+        }
+
+    def serializers(self):
+        "the serializers this side can speak, most preferred first"
+        preferred = [
+            name for name in constants.serializer_preference
+            if name in serializers
+        ]
+        return preferred + sorted(set(serializers) - set(preferred))
+
+    def get_configuration(self):
+        return self.serializer.dump(self.configuration())
+
+    def objects(self, in_file):
+        "load the objects framed in in_file"
+        if isinstance(in_file, RequestBody):
+            payloads = in_file
+        else:
+            payloads = self.framing.frames(in_file)
+
+        for payload in payloads:
+            obj = self.serializer.load(payload)
+            yield self.spool.lazy(obj) if self.spool else obj
+
+    def write(self, out_file, obj):
+        if self.spool:
+            obj = self.spool.spill(obj)
+
+        out_file.write(self.framing.frame(self.serializer.dump_bytes(obj)))
+
+    def emit(self, out_file, objs):
+        """\
+        write objs as they are produced. out_file is a FrameWriter, which
+        flushes every so often so the next stage can start on them before
+        we're done.
+        """
+        for obj in objs:
+            self.write(out_file, obj)
 
     def run(self, args=None):
         command = (args or sys.argv)[-1]
 
+        # frames are bytes, so skip the text layer where there is one
+        in_file = getattr(sys.stdin, 'buffer', sys.stdin)
+        out_file = getattr(sys.stdout, 'buffer', sys.stdout)
+
+        if command == 'serve':
+            self.serve(in_file, out_file)
+
+        elif not self.respond(command, in_file, out_file):
+            sys.stderr.write('Cannot do "%s"\n' % command)
+
+        out_file.flush()
+
+    def respond(self, command, in_file, out_file):
+        "write the response to a single command, or return False if unknown"
+        writer = FrameWriter(out_file, self.output_buffer_size)
+        writer.start()
+        try:
+            return self._respond(command, in_file, writer)
+        finally:
+            writer.close()
+
+    def _respond(self, command, in_file, out_file):
         if command == 'config':
-            sys.stdout.write(self.get_configuration() + '\n')
+            self.write(out_file, self.configuration())
 
         elif command == 'process':
-            for obj in self.process(sys.stdin):
-                sys.stdout.write(self.serializer.dump(obj) + '\n')
+            self.emit(out_file, self.process(in_file))
 
         elif command == 'start':
-            for obj in self.start():
-                sys.stdout.write(self.serializer.dump(obj) + '\n')
+            self.emit(out_file, self.start())
+
+        elif command == 'map' and 'map' in self.commands:
+            self.emit(out_file, self.map(in_file))
 
         else:
-            sys.stderr.write('Cannot do "%s"\n' % command)
+            return False
 
+        return True
+
+    def serve(self, in_file, out_file):
+        """\
+        answer framed requests until the input closes. Each request is a
+        header (``{"command": ...}``), the input objects and an empty frame.
+        Each response is the output objects followed by an empty frame.
+        """
+        while True:
+            header = self.framing.read(in_file)
+            if header is None:
+                break
+
+            command = self.serializer.load(header)['command']
+            body = RequestBody(self.framing, in_file)
+            if self.spool:
+                # so this request's data can be collected apart from the last
+                self.spool.rotate()
+
+            if not self.respond(command, body, out_file):
+                sys.stderr.write('Cannot do "%s"\n' % command)
+
+            body.drain()
+            out_file.write(self.framing.frame(b''))
+            out_file.flush()
+
+
+class MappingHandler(StdIOHandler):
+    """\
+    a handler whose output can be traced back to the input object it came
+    from, by implementing `each` (and optionally `finish`). Input is read
+    one object at a time, so output starts before the input has all arrived.
+    """
+    commands = StdIOHandler.commands + ['map']
 
-class Collector(StdIOHandler):
-    "Base class for converters"
     def process(self, in_file):
-        "process the file supplied by the superclass"
-        for line in in_file.readlines():
-            parsed = self.parse(self.serializer.load(line))
+        for obj in self.objects(in_file):
+            for out in self.each(obj):
+                yield out
 
-            if parsed:
-                yield parsed
+        for obj in self.finish():
+            yield obj
+
+    def map(self, in_file):
+        """\
+        like process, but yield a list of outputs for each input object and
+        then one last list with the output of `finish`
+        """
+        for obj in self.objects(in_file):
+            yield list(self.each(obj))
+
+        yield list(self.finish())
+
+    def finish(self):
+        return []
+
+
+class Collector(MappingHandler):
+    "Base class for converters"
+    def sorter(self, key=None, limit=None):
+        """\
+        an ExternalSort for aggregating in `final` without holding every
+        object in memory
+        """
+        return ExternalSort(
+            key, limit, serializer=self.serializer,
+            load=self.spool.lazy if self.spool else None,
+        )
 
+    def each(self, obj):
+        parsed = self.parse(obj)
+
+        if parsed:
+            yield parsed
+
+    def finish(self):
         # some converters might want to output files after each file has been
         # processed - implement "final" to do that.
         try:
@@ -60,9 +317,139 @@ class Collector(StdIOHandler):
             pass
 
 
-class Renderer(StdIOHandler):
-    "base class for renderers"
+# the renderer in each of a parallel Renderer's pool processes
+_renderer = None
+
+
+def _fork_context():
+    """\
+    a multiprocessing context that forks, or None where there's no fork.
+    Other start methods import the stage script again in every worker,
+    which would run the stage there too.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:  # Python 2, which always forks
+        return multiprocessing
+    except ValueError:
+        return None
+
+
+def _start_renderer(renderer):
+    global _renderer
+    _renderer = renderer
+
+
+def _render(obj):
+    return list(_renderer.each(obj))
+
+
+class Renderer(MappingHandler):
+    """\
+    base class for renderers. Set `workers` to render in that many processes
+    at once (0 for one per CPU), and `ordered` to False to let output come
+    out in whatever order it's rendered. Workers are forked, so where there
+    is no fork rendering stays in this process.
+
+    Set `memoize` to keep rendered output in a RenderCache, so inputs seen
+    before skip `render`. List the files rendering reads (templates, say) in
+    `dependencies`; changing them or the stage itself starts afresh, both
+    here and in the router's record of what the stage made before.
+    """
+    workers = 1
+    ordered = True
+    chunksize = 8
+    memoize = False
+
+    @property
+    def memo(self):
+        "the RenderCache, if we memoize"
+        if not self.memoize:
+            return None
+
+        if getattr(self, '_memo', None) is None:
+            directory = self.config.get(constants.render_cache_key) or \
+                os.path.join(constants.cache_dir, 'render')
+            source = getattr(sys.modules.get(type(self).__module__), '__file__', None)
+            self._memo = RenderCache(directory, salt=RenderCache.salt_for(
+                ([source] if source else []) + list(self.dependencies)
+            ))
+
+        return self._memo
+
+    def fingerprint(self, obj):
+        "a stable serialization of obj, to key the memo on"
+        obj = plain(obj)
+        try:
+            return json.dumps(obj, sort_keys=True).encode('utf-8')
+        except TypeError:  # bytes and such
+            return self.serializer.dump_bytes(obj)
+
+    def each(self, obj):
+        memo = self.memo
+        if memo is None:
+            fname, rendered = self.render(obj)
+        else:
+            key = memo.key(self.fingerprint(obj))
+            hit = memo.get(key)
+            if hit is None:
+                fname, rendered = self.render(obj)
+                memo.set(key, fname, rendered)
+            else:
+                fname, rendered = hit
+
+        yield {'filename': fname, 'content': rendered}
+
+    def rendered(self, in_file, ordered=True):
+        "the output of `each` for every input object, from a pool of workers"
+        # spooled fields have to be read here; the spool can't be pickled
+        objs = (plain(obj) for obj in self.objects(in_file))
+        pool = _fork_context().Pool(self.workers or None, _start_renderer, (self,))
+        finished = False
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for out in imap(_render, objs, self.chunksize):
+                yield out
+
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+
+            pool.join()
+
+    @property
+    def parallel(self):
+        return self.workers != 1 and _fork_context() is not None
+
     def process(self, in_file):
-        for line in in_file.readlines():
-            fname, rendered = self.render(self.serializer.load(line))
-            yield {'filename': fname, 'content': rendered}
+        if not self.parallel:
+            for obj in MappingHandler.process(self, in_file):
+                yield obj
+
+            return
+
+        for out in self.rendered(in_file, self.ordered):
+            for obj in out:
+                yield obj
+
+        for obj in self.finish():
+            yield obj
+
+    def map(self, in_file):
+        if not self.parallel:
+            for group in MappingHandler.map(self, in_file):
+                yield group
+
+            return
+
+        # groups have to line up with the input, so these are always ordered
+        for out in self.rendered(in_file):
+            yield out
+
+        yield list(self.finish())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from hashlib import sha1
+import json
+import os
+from shlex import split
+import tempfile
+
+from py.path import local
+
+from .config import constants
+
+
+def digest(data):
+    return sha1(data).hexdigest()
+
+
+def digest_files(paths):
+    "a digest that changes whenever any of the files at `paths` do"
+    parts = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                parts.append(digest(f.read()))
+        except EnvironmentError:
+            parts.append('missing')
+
+        parts.append(os.path.abspath(path))
+
+    return digest('\n'.join(parts).encode('utf-8'))
+
+
+def write_atomic(path, data, mode=None):
+    """\
+    write bytes to path through a temporary file, so readers never see half.
+    The file is only readable by us unless a `mode` is given.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        if mode is not None:
+            os.chmod(tmp, mode)
+
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class ConfigCache(object):
+    """\
+    remember stage configurations on disk, so unchanged stages don't need a
+    subprocess to tell us what they are.
+
+    Entries are keyed by the stage's path. They remember the file's mtime,
+    size and content hash, and the runner used to execute it. A matching
+    mtime and size is trusted as-is; otherwise the content hash decides.
+    Changing the runner (or upgrading the interpreter it points at)
+    invalidates the entry.
+    """
+    def __init__(self, directory):
+        self.root = str(directory)
+        self.directory = os.path.join(self.root, 'config')
+
+    def path(self, stage):
+        return os.path.join(
+            self.directory, digest(str(stage.pathfile).encode('utf-8')) + '.json'
+        )
+
+    def runner(self, stage):
+        "identify a stage's runner, down to the interpreter's mtime"
+        args = split(stage.runner)
+        exe = args[0] if args else ''
+        if os.path.basename(exe) == 'env' and len(args) > 1:
+            exe = args[1]
+
+        found = local(exe) if os.path.isabs(exe) else local.sysfind(exe)
+        try:
+            mtime = found.mtime()
+        except (AttributeError, EnvironmentError):
+            mtime = None
+
+        return [stage.runner.strip(), mtime]
+
+    def get(self, stage):
+        "the cached configuration for `stage`, or None if it may be stale"
+        try:
+            with open(self.path(stage)) as f:
+                entry = json.load(f)
+            stat = os.stat(str(stage.pathfile))
+        except (EnvironmentError, ValueError):
+            return None
+
+        if entry['path'] != str(stage.pathfile) or \
+           entry['runner'] != self.runner(stage):
+            return None
+
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return entry['configuration']
+
+        # touched but maybe not changed (a checkout, say.) Hashing is still
+        # far cheaper than starting the stage.
+        if entry['hash'] == digest(stage.pathfile.read_binary()):
+            self.set(stage, entry['configuration'])
+            return entry['configuration']
+
+        return None
+
+    def set(self, stage, configuration):
+        stat = os.stat(str(stage.pathfile))
+        entry = {
+            'path': str(stage.pathfile),
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'hash': digest(stage.pathfile.read_binary()),
+            'runner': self.runner(stage),
+            'configuration': configuration,
+        }
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # made by someone else in the meantime
+                pass
+
+        write_atomic(self.path(stage), json.dumps(entry).encode('utf-8'))
+
+
+class RenderCache(object):
+    """\
+    remember what a renderer made of each input, so unchanged pages skip
+    `render` altogether. Keys are a hash of the input object salted with
+    the stage and the files it depends on (templates, say); see `salt`.
+
+    Entries are files holding a small JSON header and the rendered content
+    as-is. Reading an entry touches it, and once the entries add up to more
+    than `max_bytes` the least recently used ones are removed.
+    """
+    def __init__(self, directory, max_bytes=None, salt=''):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes or constants.render_cache_bytes
+        self.salt = salt
+        self.size = None
+
+    # a salt that changes whenever any of the files at `paths` do
+    salt_for = staticmethod(digest_files)
+
+    def key(self, serialized):
+        return digest(self.salt.encode('utf-8') + b'\n' + serialized)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        "(filename, content) for key, or None"
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                content = f.read()
+            os.utime(path, None)
+        except (EnvironmentError, ValueError):
+            return None
+
+        if header.get('encoding'):
+            content = content.decode(header['encoding'])
+
+        return header['filename'], content
+
+    def set(self, key, filename, content):
+        encoding = None
+        if not isinstance(content, bytes):
+            content, encoding = content.encode('utf-8'), 'utf-8'
+
+        data = json.dumps({
+            'filename': filename, 'encoding': encoding,
+        }).encode('utf-8') + b'\n' + content
+
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # made by someone else in the meantime
+                pass
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+
+        write_atomic(path, data)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        "(last used, size, path) for every entry"
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # evicted by someone else
+                    continue
+
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        "remove least recently used entries until we're well under the cap"
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 3 // 4
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+            self.size -= size
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+
+from .cache import ConfigCache
+from .config import constants
+from .errors import OutputError
+from .executor import Executor
+from .manifest import Manifest
+from .output import OutputWriter
+from .profile import Profile
+from .router import Graph
+from .serializers import JSONSerializer
+from .spool import Spool, plain
+from .watch import watcher
+from .zygote import Zygotes
+
+
+def parser():
+    p = argparse.ArgumentParser(prog='perch')
+    commands = p.add_subparsers(dest='command')
+
+    build = commands.add_parser('build', help='run every stage in a directory')
+    build_arguments(build)
+
+    watch = commands.add_parser(
+        'watch', help='build, then rebuild what changes as files change',
+    )
+    build_arguments(watch)
+    watch.add_argument(
+        '--source', action='append', default=[], metavar='DIR',
+        dest='sources',
+        help='directory the starting stages read from; changes to it rerun '
+             'them. Can be repeated',
+    )
+
+    return p
+
+
+def build_arguments(build):
+    "the arguments `build` and `watch` share"
+    build.add_argument('stages', help='directory holding the stages')
+    build.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='how many stages to run at once (default: 1)',
+    )
+    build.add_argument(
+        '--cache', default=constants.cache_dir,
+        help='where to keep cached stage information (default: %(default)s)',
+    )
+    build.add_argument(
+        '--batch-size', type=int,
+        help='most objects to send a stage in one run (default: no limit)',
+    )
+    build.add_argument(
+        '--batch-bytes', type=int,
+        help='most bytes to send a stage in one run (default: no limit)',
+    )
+    build.add_argument(
+        '--serializer', action='append', dest='formats',
+        help='serializer to offer stages, most preferred first; can be '
+             'repeated (default: the fastest both sides support)',
+    )
+    build.add_argument(
+        '--spool', action='store_true',
+        help='pass big content fields between stages through shared memory',
+    )
+    build.add_argument(
+        '--zygote', action='store_true',
+        help='fork Python stages from a warm interpreter instead of '
+             'starting a new one for each run',
+    )
+    build.add_argument(
+        '--preload', action='append', default=[], metavar='MODULE',
+        help='module for the warm interpreter to import up front; can be '
+             'repeated (implies --zygote)',
+    )
+    build.add_argument(
+        '--profile', metavar='FILE',
+        help='write per-stage timings to FILE as JSON, and print a summary',
+    )
+    build.add_argument(
+        '--trace', metavar='FILE',
+        help='write per-stage timings to FILE in Chrome trace format',
+    )
+    build.add_argument(
+        '-o', '--output', metavar='DIR',
+        help='write rendered files (objects with a filename and content) '
+             'under DIR instead of printing them',
+    )
+    build.add_argument(
+        '--full', action='store_true',
+        help='reprocess everything instead of only what changed',
+    )
+
+
+def build(args):
+    run(args, _build)
+
+
+def watch(args):
+    run(args, _watch)
+
+
+def run(args, action):
+    "call action with a Graph for args, cleaning up after it"
+    cache = ConfigCache(args.cache)
+    spool = Spool() if args.spool else None
+    profile = Profile() if args.profile or args.trace else None
+    zygotes = Zygotes(args.preload) if args.zygote or args.preload else None
+
+    try:
+        with Graph(
+            args.stages, persistent=True, cache=cache,
+            batch_size=args.batch_size, batch_bytes=args.batch_bytes,
+            formats=args.formats, spool=spool, profile=profile,
+            zygotes=zygotes,
+        ) as graph:
+            action(args, graph)
+    finally:
+        if spool is not None:
+            spool.close()
+
+        if zygotes is not None:
+            zygotes.close()
+
+    if profile is not None:
+        report(args, profile)
+
+
+def report(args, profile):
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            profile.dump(f)
+
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            profile.dump(f, trace=True)
+
+    sys.stderr.write(profile.table() + '\n')
+
+
+def executor(args, graph):
+    return Executor(
+        graph, jobs=args.jobs,
+        manifest=None if args.full else Manifest(args.cache),
+    )
+
+
+def _build(args, graph):
+    emit(args, graph, executor(args, graph).run())
+
+
+def _watch(args, graph):
+    stages = os.path.abspath(args.stages)
+    watching = watcher([stages] + args.sources)
+    outputs, pending, sources = {}, set(graph.stages), False
+    try:
+        while True:
+            if pending or sources:
+                started = time.time()
+                try:
+                    if sources:
+                        # they read the sources themselves, so rerun them all
+                        pending.update(
+                            stage for stage in graph.stages
+                            if not stage.configuration['input_tags']
+                        )
+
+                    outputs = executor(args, graph).run(
+                        previous=outputs, dirty=pending,
+                    )
+                except Exception as e:
+                    # keep going; the next change might fix it
+                    sys.stderr.write('Build failed: %s\n' % e)
+                else:
+                    emit(args, graph, outputs)
+                    sys.stderr.write('Built in %.3fs\n' % (time.time() - started))
+                    pending, sources = set(), False
+
+                if graph.options['spool'] is not None:
+                    # spooled data nothing kept points at is garbage now
+                    graph.options['spool'].collect(
+                        obj for objs in outputs.values() for obj in objs
+                    )
+
+            for path in sorted(watching.changes()):
+                if path.startswith(stages + os.sep):
+                    pending.update(graph.reload(path))
+                else:
+                    sources = True
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watching.close()
+
+
+def emit(args, graph, outputs):
+    "print or write out the results of a build"
+    # stages nobody consumes from hold the results of the build
+    serializer = JSONSerializer()
+    consumed = set(tag for tag, stages in graph.graph.items() if stages)
+    files = []
+    for stage in graph.stages:
+        config = stage.configuration
+        if consumed.intersection(config['output_tags']):
+            continue
+
+        for obj in outputs[config['name']]:
+            if args.output and 'filename' in obj and 'content' in obj:
+                files.append(obj)
+                continue
+
+            try:
+                dumped = serializer.dump(plain(obj))
+            except TypeError:  # bytes, most likely; JSON has no place for them
+                raise OutputError(
+                    '%s put out an object that cannot be printed as JSON '
+                    '(binary content?); write files with -o DIR instead' %
+                    config['name']
+                )
+
+            sys.stdout.write(dumped + '\n')
+
+    if args.output:
+        counts = OutputWriter(args.output).write(files)
+        sys.stderr.write(
+            '%(written)d files written, %(unchanged)d unchanged\n' % counts
+        )
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+
+    if args.command == 'build':
+        build(args)
+    elif args.command == 'watch':
+        watch(args)
+    else:
+        parser().print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,51 @@ class Settings(dict):
 constants = Settings({
     'stage_env_var': 'PERCH_CONFIG',
 
+    # objects can say which of their stage's output tags they belong to. It's
+    # namespaced like the spool's handles, so a `tag` field in a post is
+    # just data
+    'tag_key': '$tag',
+
     # serializer stuff
     'serializer_key': 'serializer',
     'default_serializer': 'json',
+    # fastest first; the router picks the first one both sides speak
+    'serializer_preference': ['msgpack', 'fastjson', 'json'],
+
+    # spooling big fields out of serialized objects
+    'spool_key': 'spool',
+    'spool_threshold': 64 * 1024,
+    'spool_fields': ['content'],
+
+    # stages write output in chunks of about this many bytes, flushing at
+    # least this often (in seconds) while working
+    'output_buffer_size': 64 * 1024,
+    'flush_interval': 0.05,
+
+    # objects an ExternalSort keeps in memory before spilling to disk
+    'sort_buffer': 10000,
+
+    # stages asked for their configuration at once when building a graph
+    'probe_jobs': 16,
+
+    # files written at once by an OutputWriter
+    'output_jobs': 8,
+
+    # watch mode: seconds between polls when there's no inotify, and how
+    # long inotify events have to stop for before we rebuild
+    'watch_interval': 0.5,
+    'watch_settle': 0.05,
+
+    # caching
+    'cache_dir': '.perch-cache',
+    'render_cache_key': 'render_cache',
+    'render_cache_bytes': 256 * 1024 * 1024,
+
+    # files in stage directories that are never stages
+    'ignore_patterns': [
+        '.*',  # .git, .perch-cache, .DS_Store, vim swap files and friends
+        '*~', '#*#',  # editor backups
+        '*.pyc', '*.pyo', '__pycache__',
+        '*.swp', '*.swo', '*.orig', '*.rej',
+    ],
 })
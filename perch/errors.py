@@ -6,3 +6,23 @@ class BadRunner(Exception):
 
 class BadExit(Exception):
     pass
+
+class CycleError(PerchError):
+    pass
+
+class DuplicateStage(PerchError):
+    pass
+
+class RoutingError(PerchError):
+    pass
+
+class OutputError(PerchError):
+    pass
+
+class ConfigurationError(PerchError):
+    "some stages couldn't tell us their configuration"
+    def __init__(self, errors):
+        self.errors = errors
+        PerchError.__init__(self, '\n\n'.join(
+            '%r: %s' % (stage, error) for stage, error in errors
+        ))
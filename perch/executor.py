@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from .errors import CycleError
+from .router import Router
+
+
+class Executor(object):
+    """\
+    run every stage in a Graph once all the stages producing its input tags
+    have finished, running up to `jobs` independent stages at once.
+
+    Stages do their work in subprocesses, so a pool of threads waiting on
+    them is enough to keep `jobs` cores busy.
+    """
+    def __init__(self, graph, jobs=1, manifest=None):
+        self.graph = graph
+        self.jobs = max(1, jobs)
+        self.manifest = manifest
+        self.router = Router(graph)
+        self._dependencies = None
+
+    @property
+    def dependencies(self):
+        "worked out on first use, since it needs every stage's configuration"
+        if self._dependencies is None:
+            self._dependencies = self._find_dependencies()
+
+        return self._dependencies
+
+    def _find_dependencies(self):
+        "map each stage to the stages producing any of its input tags"
+        position = dict((stage, i) for i, stage in enumerate(self.graph.stages))
+        deps = {}
+        for stage in self.graph.stages:
+            producers = set()
+            for tag in stage.configuration['input_tags']:
+                producers.update(self.graph.producers(tag))
+
+            producers.discard(stage)
+            deps[stage] = sorted(producers, key=position.get)
+
+        return deps
+
+    def order(self):
+        "stages in an order where every stage comes after its producers"
+        done, ordered = set(), []
+        waiting = list(self.graph.stages)
+
+        while waiting:
+            ready = [s for s in waiting if done.issuperset(self.dependencies[s])]
+            if not ready:
+                raise CycleError('Stages depend on each other: %s' % ', '.join(
+                    stage.configuration['name'] for stage in waiting
+                ))
+
+            for stage in ready:
+                waiting.remove(stage)
+                done.add(stage)
+                ordered.append(stage)
+
+        return ordered
+
+    def inputs(self, stage, initial, inbox):
+        """\
+        everything routed to `stage`: seeded objects, then what each of its
+        producers sent it
+        """
+        objs = []
+        for tag in stage.configuration['input_tags']:
+            objs.extend(initial.get(tag, []))
+
+        routed = inbox.pop(stage, {})
+        for producer in self.dependencies[stage]:
+            objs.extend(routed.get(producer, []))
+
+        return objs
+
+    def execute(self, stage, objs):
+        "run a single stage; stages without input tags are asked to start"
+        if not stage.configuration['input_tags']:
+            return stage.request('start')
+
+        if self.manifest is not None and \
+           'map' in stage.configuration.get('commands', []):
+            return self.manifest.process(stage, objs)
+
+        return stage.process(objs)
+
+    def downstream(self, stages):
+        "stages, and every stage that consumes from them directly or not"
+        affected = set(stages)
+        for stage in self.order():
+            if affected.intersection(self.dependencies[stage]):
+                affected.add(stage)
+
+        return affected
+
+    def run(self, initial=None, previous=None, dirty=None):
+        """\
+        run the whole graph, returning a dict of stage name to output. Seed
+        objects can be passed in `initial`, as a dict of tag to objects.
+
+        To rerun part of the graph, pass the output of an earlier run as
+        `previous` and the stages that changed as `dirty`. Only they and the
+        stages downstream of them run; the rest pass on their earlier output.
+
+        If any stage fails, no new stages are started; the ones already
+        running are allowed to finish and the first error is raised.
+        """
+        initial = initial or {}
+        previous = previous or {}
+        waiting = self.order()
+        if dirty is None:
+            affected = set(waiting)
+        else:
+            affected = self.downstream(dirty)
+        outputs = {}
+        inbox = {}
+        running = set()
+        finished = Queue()
+        error = None
+
+        def work(stage, objs):
+            try:
+                finished.put((stage, self.execute(stage, objs), None))
+            except Exception as e:
+                finished.put((stage, None, e))
+
+        pool = ThreadPool(self.jobs)
+        try:
+            while waiting or running:
+                if error is None:
+                    for stage in list(waiting):
+                        if len(running) >= self.jobs:
+                            break
+
+                        if not set(outputs).issuperset(self.dependencies[stage]):
+                            continue
+
+                        waiting.remove(stage)
+                        running.add(stage)
+                        name = stage.configuration['name']
+                        if stage not in affected and name in previous:
+                            inbox.pop(stage, None)
+                            finished.put((stage, previous[name], None))
+                            continue
+
+                        pool.apply_async(work, (
+                            stage, self.inputs(stage, initial, inbox)
+                        ))
+
+                if not running:
+                    break
+
+                stage, out, exc = finished.get()
+                running.remove(stage)
+                if exc is None:
+                    try:
+                        routed = self.router.dispatch(stage, out)
+                    except Exception as e:
+                        exc = e
+
+                if exc is not None:
+                    error = error or exc
+                else:
+                    outputs[stage] = out
+                    for consumer, objs in routed.items():
+                        inbox.setdefault(consumer, {})[stage] = objs
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            raise error
+
+        return dict(
+            (stage.configuration['name'], out)
+            for stage, out in outputs.items()
+        )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import struct
+
+from .utils import ClassRegistry
+
+framings = ClassRegistry()
+
+
+@framings.register('line')
+class LineFraming(object):
+    """\
+    one payload per line. Payloads can't contain newlines, which is fine
+    for JSON and means stages can be written with nothing but print.
+    """
+    unterminated = True  # a last line without a newline still counts
+    def frame(self, payload):
+        return payload + b'\n'
+
+    def read(self, stream):
+        "read one payload, or None at the end of the stream"
+        line = stream.readline()
+        if not line:
+            return None
+
+        # text streams work too, which keeps hand-written stages simple
+        if line[-1:] in (b'\n', '\n'):
+            line = line[:-1]
+
+        return line
+
+    def is_empty(self, payload):
+        if isinstance(payload, memoryview):
+            # only copy the ones that could be blank
+            if payload[:1].tobytes().strip():
+                return False
+
+            payload = payload.tobytes()
+
+        return not payload.strip()
+
+    def find(self, buf, start, end, scanned=None):
+        """\
+        (payload start, payload end, frame end) for the first whole frame in
+        buf[start:end], or None if there isn't one yet. buf[start:scanned]
+        is known not to finish a frame, so a long line isn't searched over
+        and over as it comes in.
+        """
+        newline = buf.find(b'\n', max(start, scanned or start), end)
+        if newline < 0:
+            return None
+
+        return start, newline, newline + 1
+
+    def frames(self, stream, until_empty=True):
+        """\
+        yield payloads until the stream ends or, if `until_empty`, until an
+        empty payload marks the end of a request. Otherwise empty payloads
+        are skipped.
+        """
+        while True:
+            payload = self.read(stream)
+            if payload is None:
+                return
+
+            if self.is_empty(payload):
+                if until_empty:
+                    return
+
+                continue
+
+            yield payload
+
+
+@framings.register('length')
+class LengthFraming(LineFraming):
+    "payloads prefixed with their length, so they can hold any bytes at all"
+    header = struct.Struct('>I')
+    unterminated = False
+
+    def is_empty(self, payload):
+        return not payload
+
+    def frame(self, payload):
+        return self.header.pack(len(payload)) + payload
+
+    def find(self, buf, start, end, scanned=None):
+        if end - start < self.header.size:
+            return None
+
+        size, = self.header.unpack_from(buf, start)
+        begin = start + self.header.size
+        if end - begin < size:
+            return None
+
+        return begin, begin + size, begin + size
+
+    def _read_exactly(self, stream, size):
+        data = b''
+        while len(data) < size:
+            chunk = stream.read(size - len(data))
+            if not chunk:
+                break
+
+            data += chunk
+
+        return data
+
+    def read(self, stream):
+        header = self._read_exactly(stream, self.header.size)
+        if len(header) < self.header.size:
+            return None
+
+        size, = self.header.unpack(header)
+        payload = self._read_exactly(stream, size)
+        if len(payload) < size:
+            return None
+
+        return payload
+
+
+class FrameReader(object):
+    """\
+    read frames from a binary stream into one reusable buffer, handing out
+    each payload as a memoryview of it as soon as the whole frame is in. A
+    payload is only good until the next read, but nothing is copied on the
+    way and the buffer only grows to fit the biggest frame.
+    """
+    def __init__(self, framing, stream, size=64 * 1024):
+        self.framing = framing
+        self.stream = stream
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        self.scanned = 0  # buf[start:scanned] holds no frame end
+
+    def fill(self):
+        "make room and read more, returning False at the end of the stream"
+        pending = self.end - self.start
+        if self.start and pending:
+            self.buf[:pending] = self.view[self.start:self.end].tobytes()
+        self.scanned = max(self.scanned - self.start, 0)
+        self.start, self.end = 0, pending
+
+        if self.end == len(self.buf):
+            # a frame bigger than the buffer. Payloads handed out earlier may
+            # still be looking at the old one, so start a new one.
+            buf = bytearray(len(self.buf) * 2)
+            buf[:self.end] = self.view[:self.end]
+            self.buf, self.view = buf, memoryview(buf)
+
+        # readinto1 hands back whatever has arrived instead of waiting for
+        # the whole buffer to fill
+        readinto = getattr(self.stream, 'readinto1', None) or self.stream.readinto
+        read = readinto(self.view[self.end:])
+        if not read:
+            return False
+
+        self.end += read
+        return True
+
+    def read(self):
+        "the next payload, or None at the end of the stream"
+        while True:
+            found = self.framing.find(
+                self.buf, self.start, self.end, self.scanned
+            )
+            if found is not None:
+                begin, end, self.start = found
+                return self.view[begin:end]
+
+            self.scanned = self.end
+            if not self.fill():
+                break
+
+        if self.start < self.end and self.framing.unterminated:
+            begin, self.start = self.start, self.end
+            return self.view[begin:self.end]
+
+        return None
+
+    def frames(self, until_empty=True):
+        "like LineFraming.frames"
+        while True:
+            payload = self.read()
+            if payload is None:
+                return
+
+            if self.framing.is_empty(payload):
+                if until_empty:
+                    return
+
+                continue
+
+            yield payload
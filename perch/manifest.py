@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+
+from .cache import digest, digest_files, write_atomic
+from .serializers import JSONSerializer
+from .spool import plain
+
+BYTES_KEY = '$bytes'
+
+
+class Encoder(JSONSerializer.Encoder):
+    "JSON that can hold bytes (images and such), as base64"
+    def default(self, obj):
+        if isinstance(obj, bytes):
+            return {BYTES_KEY: base64.b64encode(obj).decode('ascii')}
+
+        return JSONSerializer.Encoder.default(self, obj)
+
+
+def revive(obj):
+    "turn what Encoder made of bytes back into bytes"
+    if len(obj) == 1 and BYTES_KEY in obj:
+        return base64.b64decode(obj[BYTES_KEY])
+
+    return obj
+
+
+class Manifest(object):
+    """\
+    remember, for every stage, a hash of each input object and the outputs
+    that object produced, so later builds only send new or changed objects
+    through the stage.
+
+    Stages must support the `map` command for this (the `Collector` and
+    `Renderer` bases do.) Stages that aggregate (`Collector.final`) are
+    still skipped when none of their input changed, but get all of their
+    input again when any of it does, since `final` needs to see everything.
+
+    Files a stage lists in its `dependencies` (templates, say) count as part
+    of the stage: changing them reprocesses everything.
+
+    Each stage has a small index file listing the input hashes it has seen.
+    The outputs themselves are kept one file per input, under a key made
+    from the stage and the input's hash, so a build only reads the outputs
+    it hands on and only writes the ones that changed.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.join(str(directory), 'manifest')
+        self.objects = os.path.join(self.directory, 'objects')
+        self.encoder = Encoder(sort_keys=True)
+
+    def hash(self, obj):
+        return digest(self.encoder.encode(plain(obj)).encode('utf-8'))
+
+    def path(self, stage):
+        return os.path.join(
+            self.directory, digest(str(stage.pathfile).encode('utf-8')) + '.json'
+        )
+
+    def fingerprint(self, stage):
+        "changes whenever the stage itself or a file it depends on does"
+        dependencies = stage.configuration.get('dependencies', [])
+        return digest(
+            stage.pathfile.read_binary() + stage.runner.encode('utf-8') +
+            digest_files(dependencies).encode('utf-8')
+        )
+
+    def key(self, entry, name):
+        "where the outputs recorded under `name` (an input hash) live"
+        return digest(('%s\n%s\n%s' % (
+            entry['path'], entry['stage'], name
+        )).encode('utf-8'))
+
+    def object_path(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def makedirs(self, path):
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:  # made by someone else in the meantime
+                pass
+
+    def get(self, stage):
+        "the index for `stage`, whether or not it's still good"
+        try:
+            with open(self.path(stage)) as f:
+                return json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+
+    def set(self, stage, entry):
+        self.makedirs(self.directory)
+        write_atomic(self.path(stage), self.encoder.encode(entry).encode('utf-8'))
+
+    def load(self, entry, name):
+        "the outputs recorded under `name`, or None if they've gone missing"
+        try:
+            with open(self.object_path(self.key(entry, name)), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'), object_hook=revive)
+        except (EnvironmentError, ValueError):
+            return None
+
+    def store(self, entry, name, objs):
+        path = self.object_path(self.key(entry, name))
+        self.makedirs(os.path.dirname(path))
+        write_atomic(path, self.encoder.encode(objs).encode('utf-8'))
+
+    def forget(self, entry, names):
+        "remove the outputs recorded under names"
+        for name in names:
+            try:
+                os.unlink(self.object_path(self.key(entry, name)))
+            except OSError:
+                pass
+
+    def process(self, stage, objs):
+        "like Stage.process, but reusing recorded output wherever possible"
+        objs = list(objs)
+        hashes = [self.hash(obj) for obj in objs]
+        inputs = digest(''.join(hashes).encode('utf-8'))
+
+        fresh = {
+            'path': str(stage.pathfile), 'stage': self.fingerprint(stage),
+            'inputs': None, 'outputs': [],
+        }
+        entry = self.get(stage)
+        if entry is None or entry.get('stage') != fresh['stage'] or \
+           entry.get('path') != fresh['path']:
+            if entry is not None and 'path' in entry:
+                self.forget(entry, entry['outputs'] + ['final'])
+            entry = fresh
+
+        known = {}
+        final = None
+        if entry['inputs'] == inputs:
+            for h in set(hashes):
+                known[h] = self.load(entry, h)
+            final = self.load(entry, 'final')
+
+        if final is None or None in known.values():
+            known, final = self.run(stage, objs, hashes, entry)
+
+            recorded = set(entry['outputs'])
+            self.forget(entry, recorded - set(hashes))
+            entry['inputs'] = inputs
+            entry['outputs'] = sorted(known)
+            self.set(stage, entry)
+
+        out = []
+        for h in hashes:
+            out.extend(known[h])
+
+        out.extend(final)
+        return out
+
+    def run(self, stage, objs, hashes, entry):
+        """\
+        send whatever hasn't been seen before through the stage, recording
+        the outputs. Returns the outputs for every hash, and those of final.
+        """
+        known, final = {}, None
+        if not stage.configuration.get('aggregates'):
+            for h in set(entry['outputs']).intersection(hashes):
+                loaded = self.load(entry, h)
+                if loaded is not None:
+                    known[h] = loaded
+
+            final = self.load(entry, 'final')
+
+        todo = [i for i, h in enumerate(hashes) if h not in known]
+        if not todo and final is not None:  # only removals; nothing to run
+            return known, final
+
+        groups = stage.map([objs[i] for i in todo])
+        final = [plain(obj) for obj in groups.pop()]
+        self.store(entry, 'final', final)
+
+        # spooled data goes away with the build, so keep the real thing
+        for i, group in zip(todo, groups):
+            group = [plain(obj) for obj in group]
+            known[hashes[i]] = group
+            self.store(entry, hashes[i], group)
+
+        return known, final
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Lock
+
+from .cache import write_atomic
+from .config import constants
+from .errors import OutputError
+
+
+class OutputWriter(object):
+    """\
+    write rendered objects (``{'filename': ..., 'content': ...}``) under
+    `directory`, `jobs` files at a time. Every file is written atomically,
+    and files that already hold the same content are left alone, so their
+    mtimes only change when they do.
+    """
+    def __init__(self, directory, jobs=None):
+        self.directory = os.path.abspath(str(directory))
+        self.jobs = jobs or constants.output_jobs
+        self.made = set()
+        self.lock = Lock()
+
+        # mkstemp files are private; outputs get the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def path(self, filename):
+        "where filename goes, refusing anything outside the directory"
+        path = os.path.normpath(os.path.join(self.directory, filename))
+        if not path.startswith(self.directory + os.sep):
+            raise OutputError('%r is outside %s' % (filename, self.directory))
+
+        return path
+
+    def makedirs(self, directory):
+        "make directory once, however many files go in it"
+        if directory in self.made:
+            return
+
+        with self.lock:
+            if directory not in self.made:
+                if not os.path.isdir(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError:  # made by someone else in the meantime
+                        if not os.path.isdir(directory):
+                            raise
+
+                self.made.add(directory)
+
+    def unchanged(self, path, data):
+        try:
+            if os.path.getsize(path) != len(data):
+                return False
+
+            with open(path, 'rb') as f:
+                return f.read() == data
+        except EnvironmentError:
+            return False
+
+    def write_one(self, obj):
+        "write one object, returning whether the file changed"
+        path = self.path(obj['filename'])
+        data = obj['content']
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        if self.unchanged(path, data):
+            return False
+
+        self.makedirs(os.path.dirname(path))
+        write_atomic(path, data, self.mode)
+        return True
+
+    def write(self, objs):
+        "write every object, returning how many files were written and skipped"
+        counts = {'written': 0, 'unchanged': 0}
+        pool = ThreadPool(self.jobs)
+        try:
+            for changed in pool.imap_unordered(self.write_one, objs):
+                counts['written' if changed else 'unchanged'] += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        return counts
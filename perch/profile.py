@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import sys
+from threading import Lock
+import time
+
+
+class Record(object):
+    "measurements for one command run against one stage"
+    def __init__(self, stage, command):
+        self.stage = stage
+        self.command = command
+        self.start = time.time()
+        self.spawned = None
+        self.first_output = None
+        self.end = None
+        self.objects_in = 0
+        self.objects_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.usage = None
+        self.stderr = ''
+
+    def spawn(self):
+        "mark the stage's process as started"
+        self.spawned = time.time()
+
+    def count_in(self, frames):
+        for frame in frames:
+            self.objects_in += 1
+            self.bytes_in += len(frame)
+            yield frame
+
+    def output(self, payload):
+        if self.first_output is None:
+            self.first_output = time.time()
+
+        self.objects_out += 1
+        self.bytes_out += len(payload)
+
+    def finish(self, usage=None, stderr=None):
+        self.end = time.time()
+        self.usage = usage
+        self.stderr = str(stderr or '')
+
+    def as_dict(self):
+        def since_start(t):
+            return None if t is None else t - self.start
+
+        out = {
+            'stage': self.stage,
+            'command': self.command,
+            'start': self.start,
+            'spawn_s': since_start(self.spawned),
+            'first_output_s': since_start(self.first_output),
+            'wall_s': since_start(self.end),
+            'objects_in': self.objects_in,
+            'objects_out': self.objects_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'cpu_user_s': None,
+            'cpu_system_s': None,
+            'max_rss_kb': None,
+        }
+        if self.usage is not None:
+            scale = 1024 if sys.platform == 'darwin' else 1  # bytes on OS X
+            out.update(
+                cpu_user_s=self.usage.ru_utime,
+                cpu_system_s=self.usage.ru_stime,
+                max_rss_kb=self.usage.ru_maxrss // scale,
+            )
+        if self.stderr:
+            out['stderr'] = self.stderr
+
+        return out
+
+
+class Profile(object):
+    """\
+    collect Records from stages over a build, and report them as JSON, as a
+    Chrome trace (load it in chrome://tracing or Perfetto) or as a summary
+    table with a row per stage
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def summary(self):
+        """\
+        totals per stage. Persistent workers' `serve` records span their
+        whole life, requests and idle time alike, so they're only counted
+        in `workers` (and for their CPU time and memory); `config` probes
+        count as runs but not toward the objects and bytes moved.
+        """
+        stages = {}
+        for run in (r.as_dict() for r in self.records):
+            total = stages.setdefault(run['stage'], {
+                'runs': 0, 'workers': 0, 'wall_s': 0.0, 'first_output_s': None,
+                'objects_in': 0, 'objects_out': 0, 'bytes_in': 0, 'bytes_out': 0,
+                'cpu_s': 0.0, 'max_rss_kb': 0,
+            })
+            total['cpu_s'] += (run['cpu_user_s'] or 0) + (run['cpu_system_s'] or 0)
+            total['max_rss_kb'] = max(total['max_rss_kb'], run['max_rss_kb'] or 0)
+
+            if run['command'] == 'serve':
+                total['workers'] += 1
+                continue
+
+            total['runs'] += 1
+            total['wall_s'] += run['wall_s'] or 0
+            if run['command'] == 'config':
+                continue
+
+            for key in ('objects_in', 'objects_out', 'bytes_in', 'bytes_out'):
+                total[key] += run[key]
+
+            if run['first_output_s'] is not None:
+                total['first_output_s'] = min(
+                    total['first_output_s'] or run['first_output_s'],
+                    run['first_output_s'],
+                )
+
+        return stages
+
+    def as_dict(self):
+        return {
+            'runs': [r.as_dict() for r in self.records],
+            'stages': self.summary(),
+        }
+
+    def chrome_trace(self):
+        "the records in Chrome's trace event format, one track per stage"
+        origin = min([r.start for r in self.records] or [0])
+        tracks = {}
+        events = []
+        for record in self.records:
+            run = record.as_dict()
+            tid = tracks.setdefault(run['stage'], len(tracks) + 1)
+            events.append({
+                'name': '%s %s' % (run['stage'], run['command']),
+                'cat': run['command'],
+                'ph': 'X',
+                'pid': 1,
+                'tid': tid,
+                'ts': int((run['start'] - origin) * 1e6),
+                'dur': int((run['wall_s'] or 0) * 1e6),
+                'args': run,
+            })
+
+        events.extend(
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+             'args': {'name': stage}}
+            for stage, tid in tracks.items()
+        )
+
+        return {'traceEvents': events}
+
+    def dump(self, f, trace=False):
+        json.dump(self.chrome_trace() if trace else self.as_dict(), f, indent=2)
+
+    def table(self):
+        columns = [
+            ('stage', '%s'), ('runs', '%d'), ('workers', '%d'),
+            ('wall_s', '%.3f'), ('first_output_s', '%.3f'),
+            ('objects_in', '%d'), ('objects_out', '%d'),
+            ('bytes_in', '%d'), ('bytes_out', '%d'),
+            ('cpu_s', '%.3f'), ('max_rss_kb', '%d'),
+        ]
+        rows = [[name for name, _ in columns]]
+        summary = self.summary()
+        for stage in sorted(summary, key=lambda s: -summary[s]['wall_s']):
+            total = dict(summary[stage], stage=stage)
+            rows.append([
+                '-' if total[name] is None else fmt % total[name]
+                for name, fmt in columns
+            ])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        return '\n'.join(
+            '  '.join(cell.rjust(width) if i else cell.ljust(width)
+                      for i, (cell, width) in enumerate(zip(row, widths)))
+            for row in rows
+        )
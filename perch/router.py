@@ -1,26 +1,202 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from collections import namedtuple
+from collections import namedtuple, deque
+from copy import copy
 from functools import wraps
 from itertools import chain
+import json
+from multiprocessing.pool import ThreadPool
 import os
 from shlex import split
 from subprocess import Popen, PIPE
+from threading import Thread
+import time
+
+from py.path import local
 
 from .config import constants
+from .framing import FrameReader, framings
+from .profile import Record
 from .serializers import serializers
-from .utils import files_in_dir
-from .errors import BadRunner, BadExit
+from .utils import files_in_dir, ignored, prefetch
+from .errors import (
+    BadRunner, BadExit, ConfigurationError, DuplicateStage, RoutingError,
+)
+
+
+class Feeder(Thread):
+    """\
+    write frames to a pipe from a background thread, so a process can't
+    deadlock against us while its stdout fills up. Writes block once the pipe
+    buffer is full, so a slow stage holds back its producer instead of having
+    its input pile up in memory.
+    """
+    def __init__(self, pipe, frames, trailer=None, close=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.frames = frames
+        self.trailer = trailer
+        self.close = close
+        self.error = None
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                self.pipe.write(frame)
+                self.pipe.flush()
+
+        except (IOError, OSError):
+            return  # the process went away; whoever reads from it reports it
+
+        except Exception as e:
+            # usually an upstream stage failing; the reader re-raises this
+            self.error = e
+
+        try:
+            if self.trailer is not None:
+                self.pipe.write(self.trailer)
+
+            if self.close:
+                self.pipe.close()
+            else:
+                self.pipe.flush()
+        except (IOError, OSError):
+            pass
+
+
+class StderrTail(Thread):
+    "keep a process's stderr drained, holding on to the last few lines"
+    def __init__(self, pipe, lines=100):
+        Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.lines = deque(maxlen=lines)
+
+    def run(self):
+        for line in iter(self.pipe.readline, b''):
+            self.lines.append(line)
+
+    def __str__(self):
+        return b''.join(self.lines).decode('utf-8', 'replace')
+
+
+def spawn(cmd, env=None):
+    try:
+        return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=env)
+    except OSError:
+        raise BadRunner('No such file or directory: %s' % cmd[0])
+
+
+def reap(process):
+    """\
+    wait for a process, returning its resource usage if the OS will tell us
+    (None otherwise)
+    """
+    if process.returncode is None and hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except OSError:
+            pass
+        else:
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+
+            return usage
+
+    process.wait()
+    return None
+
+
+class Worker(object):
+    "a long-lived stage process answering framed requests over stdin/stdout"
+    def __init__(self, cmd, serializer, env=None, load=None, start=spawn):
+        self.serializer = serializer
+        self.load = load or serializer.load
+        self.framing = framings[serializer.framing]()
+        self.started = time.time()
+        self.process = start(cmd, env)
+        self.reader = FrameReader(self.framing, self.process.stdout)
+        self.spawned = time.time()
+        self.stderr = StderrTail(self.process.stderr)
+        self.stderr.start()
+
+    def stream(self, command, frames=(), record=None):
+        "send one request of framed objects, yielding objects as they arrive"
+        record = record or Record(None, command)
+        record.spawned = record.start
+        header = self.framing.frame(
+            self.serializer.dump_bytes({'command': command})
+        )
+        feeder = Feeder(
+            self.process.stdin, chain([header], frames),
+            trailer=self.framing.frame(b''),
+        )
+        feeder.start()
+
+        finished = False
+        try:
+            while True:
+                payload = self.reader.read()
+                if payload is None:
+                    break
+
+                if self.framing.is_empty(payload):
+                    finished = True
+                    break
+
+                record.output(payload)
+                yield self.load(payload)
+        finally:
+            # a half-read response would desync the next request, so a
+            # consumer giving up early costs us the worker
+            if not finished:
+                self.process.kill()
+
+        feeder.join()
+        record.finish()
+        if finished:
+            if feeder.error is not None:
+                raise feeder.error
+
+            return
+
+        reap(self.process)
+        self.stderr.join()
+        raise BadExit('Worker exited with response code %s. Stderr:\n\n%s' % (
+            self.process.returncode, self.stderr
+        ))
+
+    def close(self):
+        "stop the worker, returning its resource usage if we can get it"
+        if self.process.returncode is None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+            return reap(self.process)
 
 
 class Stage(object):
-    def __init__(self, pathfile):
+    def __init__(self, pathfile, persistent=False, cache=None,
+                 batch_size=None, batch_bytes=None, formats=None, spool=None,
+                 profile=None, zygotes=None):
         self.pathfile = pathfile
-        self.serializer = serializers.get(
-            constants.serializer_key, serializers[constants.default_serializer]
-        )()
+        self.cache = cache
+        self.zygotes = zygotes
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.formats = formats
+        self.spool = spool
+        self.profile = profile
+        self._serializer = None
 
         self.runner = self._runner()
+        self.persistent = persistent
+        self._worker = None
 
     def __eq__(self, other):
         return self.pathfile == other.pathfile
@@ -31,6 +207,17 @@ class Stage(object):
     def __repr__(self):
         return 'Stage(%r)' % self.pathfile.basename
 
+    @property
+    def label(self):
+        "the stage's name if we know it already, or its filename"
+        config = getattr(self, '_configuration', None)
+        return config['name'] if config else self.pathfile.basename
+
+    def submit(self, record):
+        "hand a finished record to the profile, if we're keeping one"
+        if self.profile is not None:
+            self.profile.add(record)
+
     runners = {
         '.py': 'python',
         '.rb': 'ruby',
@@ -41,85 +228,523 @@ class Stage(object):
 
     def _runner(self):
         "get the runner for this instance"
-        # first, look at the shebang
+        # first, look at the shebang. Stages can be big (or binary), so only
+        # read as far as we need to.
         try:
-            shebang = self.pathfile.readlines()[0]
-        except (IOError, IndexError):
-            shebang = ''
+            with self.pathfile.open('rb') as f:
+                shebang = f.readline(1024)
+        except (IOError, OSError):
+            shebang = b''
 
-        if shebang.startswith('#!'):
-            return shebang[2:]
+        if shebang.startswith(b'#!'):
+            return shebang[2:].decode('utf-8', 'replace').rstrip('\r\n')
 
         # if that didn't work, guess from the extension
         return self.runners.get(self.pathfile.ext, self.runners['.sh'])
 
-    def run(self, cmd, stdin=None, timeout=None):
-        cmd = split(self.runner) + [str(self.pathfile)] + split(cmd)
-        try:
-            response = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        except OSError:
-            raise BadRunner('No such file or directory: %s' % self.runner)
+    def command(self, cmd):
+        return split(self.runner) + [str(self.pathfile)] + split(cmd)
+
+    def spawn(self, cmd, env=None):
+        "start the stage, forking it from a zygote if we have one that fits"
+        if self.zygotes is not None and self.zygotes.fits(self.runner):
+            try:
+                return self.zygotes.spawn(
+                    self.runner, cmd[len(split(self.runner)):], env
+                )
+            except (IOError, OSError):
+                pass  # no zygote for this runner after all; start it as usual
+
+        return spawn(cmd, env)
+
+    def negotiate(self):
+        """\
+        pick the first serializer we prefer (`formats`, or the default
+        preference order) that the stage says it speaks
+        """
+        offered = self.configuration.get(
+            'serializers', [constants.default_serializer]
+        )
+        for name in self.formats or constants.serializer_preference:
+            if name in serializers and name in offered:
+                return name
+
+        return constants.default_serializer
+
+    @property
+    def serializer(self):
+        """\
+        the negotiated serializer. Negotiating needs the stage's
+        configuration; we only go and get it if a worker needs it anyway or
+        we were asked for particular formats. Until then we assume the stage
+        speaks the default.
+        """
+        if self._serializer is None:
+            wanted = self.persistent or self.formats
+            if not (wanted or getattr(self, '_configuration', None)):
+                return serializers[constants.default_serializer]()
+
+            self._serializer = serializers[self.negotiate()]()
+
+        return self._serializer
+
+    def env(self, serializer):
+        "the environment for a child speaking `serializer`"
+        env = dict(os.environ)
+        config = json.loads(env.get(constants.stage_env_var, '{}'))
+        config[constants.serializer_key] = serializer.name
+        if self.spool is not None:
+            config[constants.spool_key] = {
+                'directory': self.spool.directory,
+                'threshold': self.spool.threshold,
+            }
+        if self.cache is not None:
+            config[constants.render_cache_key] = os.path.join(
+                self.cache.root, 'render'
+            )
+        env[constants.stage_env_var] = json.dumps(config)
 
-        stdout, stderr = response.communicate(stdin.encode('utf-8') if stdin else stdin)
+        return env
 
-        if response.returncode != 0:
-            raise BadExit('Response code %s. Stdout:\n\n%s\n\nStderr:\n\n%s' % (
-                response.returncode, stdout, stderr
+    def run(self, cmd, stdin=None, timeout=None, serializer=None):
+        record = Record(self.label, cmd)
+        cmd = self.command(cmd)
+        serializer = serializer or self.serializer
+        process = self.spawn(cmd, self.env(serializer))
+
+        record.spawn()
+        if stdin and not isinstance(stdin, bytes):
+            stdin = stdin.encode('utf-8')
+
+        stderr = StderrTail(process.stderr)
+        stderr.start()
+        feeder = Feeder(process.stdin, [stdin] if stdin else [], close=True)
+        feeder.start()
+
+        # objects are loaded as their frames come in, so we never hold more
+        # than one frame of raw output
+        reader = FrameReader(framings[serializer.framing](), process.stdout)
+        loaded = []
+        for payload in reader.frames(until_empty=False):
+            record.output(payload)
+            loaded.append(self.load(serializer, payload))
+
+        feeder.join()
+        usage = reap(process)
+        stderr.join()
+        record.bytes_in = len(stdin or b'')
+        record.finish(usage, stderr)
+
+        if process.returncode != 0:
+            raise BadExit('Response code %s. Stderr:\n\n%s' % (
+                process.returncode, stderr
             ))
 
-        loaded = [
-            self.serializer.load(line)
-            for line in stdout.decode('utf-8').split('\n')
-            if line
-        ]
+        if record.command == 'config' and loaded:
+            record.stage = loaded[0].get('name', record.stage)
 
-        return loaded, stderr, response.returncode
+        self.submit(record)
+        return loaded, b''.join(stderr.lines), process.returncode
 
     @property
     def configuration(self):
         if not getattr(self, '_configuration', None):
-            out, _, _ = self.run('config')
-            self._configuration = out[0]
+            cached = self.cache.get(self) if self.cache is not None else None
+            if cached is not None:
+                self._configuration = cached
+            else:
+                # negotiation needs this, so it's always in the default
+                out, _, _ = self.run(
+                    'config',
+                    serializer=serializers[constants.default_serializer](),
+                )
+                self._configuration = out[0]
+
+                if self.cache is not None:
+                    self.cache.set(self, self._configuration)
 
         return self._configuration
 
+    @property
+    def serves(self):
+        "whether requests go to a persistent worker instead of one-shot runs"
+        return self.persistent and 'serve' in self.configuration.get('commands', [])
+
+    @property
+    def worker(self):
+        if self._worker is None or self._worker.process.poll() is not None:
+            serializer = self.serializer
+            self._worker = Worker(
+                self.command('serve'), serializer, self.env(serializer),
+                load=lambda payload: self.load(serializer, payload),
+                start=self.spawn,
+            )
+
+        return self._worker
+
+    def frames(self, objs, serializer=None):
+        "serialize and frame objs for the stage's stdin"
+        serializer = serializer or self.serializer
+        framing = framings[serializer.framing]()
+        for obj in objs:
+            if self.spool is not None:
+                obj = self.spool.spill(obj)
+
+            yield framing.frame(serializer.dump_bytes(obj))
+
+    def load(self, serializer, payload):
+        "load an object from the stage, leaving spooled fields where they are"
+        obj = serializer.load(payload)
+        if self.spool is not None:
+            return self.spool.lazy(obj)
+
+        return obj
+
+    def batches(self, objs, serializer=None):
+        """\
+        serialize objs into lists of frames holding at most `batch_size`
+        objects and `batch_bytes` bytes (a single bigger object gets a batch
+        to itself.) There is always at least one batch, even if it's empty.
+        """
+        batch, size, emitted = [], 0, False
+        for frame in self.frames(objs, serializer):
+            if batch and (
+                (self.batch_size and len(batch) >= self.batch_size) or
+                (self.batch_bytes and size + len(frame) > self.batch_bytes)
+            ):
+                yield batch
+                batch, size, emitted = [], 0, True
+
+            batch.append(frame)
+            size += len(frame)
+
+        if batch or not emitted:
+            yield batch
+
+    def stream(self, cmd, objs=()):
+        """\
+        run a command against the stage, feeding it objs as they are produced
+        and yielding output objects as soon as their frames arrive
+        """
+        serializer = self.serializer
+        return self._stream(cmd, self.frames(objs, serializer), serializer)
+
+    def _stream(self, cmd, frames, serializer):
+        record = Record(self.label, cmd)
+        if self.profile is not None:
+            frames = record.count_in(frames)
+
+        if self.serves:
+            return self._stream_worker(cmd, frames, record)
+
+        return self._stream_once(cmd, frames, serializer, record)
+
+    def _stream_worker(self, cmd, frames, record):
+        for obj in self.worker.stream(cmd, frames, record):
+            yield obj
+
+        self.submit(record)
+
+    def _stream_once(self, cmd, frames, serializer, record):
+        process = self.spawn(self.command(cmd), self.env(serializer))
+        record.spawn()
+        stderr = StderrTail(process.stderr)
+        stderr.start()
+        feeder = Feeder(process.stdin, frames, close=True)
+        feeder.start()
+
+        reader = FrameReader(framings[serializer.framing](), process.stdout)
+        finished = False
+        try:
+            for payload in reader.frames(until_empty=False):
+                record.output(payload)
+                yield self.load(serializer, payload)
+
+            finished = True
+        finally:
+            # stop the process if our consumer gave up early
+            if not finished:
+                process.kill()
+                process.wait()
+
+        feeder.join()
+        usage = reap(process)
+        stderr.join()
+        record.finish(usage, stderr)
+        self.submit(record)
+        if feeder.error is not None:
+            raise feeder.error
+
+        if process.returncode != 0:
+            raise BadExit('Response code %s. Stderr:\n\n%s' % (
+                process.returncode, stderr
+            ))
+
+    def request(self, cmd, objs=()):
+        "run a command against the stage, reusing the worker if there is one"
+        return list(self.stream(cmd, objs))
+
+    @property
+    def batched(self):
+        return bool(self.batch_size or self.batch_bytes) and \
+            not self.configuration.get('aggregates')
+
     def process(self, objs):
-        lines = '\n'.join(
-            self.serializer.dump(obj)
-            for obj in objs
-        )
-        out, _, _ = self.run('process', lines)
+        """\
+        process objs, in batches if `batch_size` or `batch_bytes` are set.
+        Each batch is serialized while the one before it is being processed,
+        and output keeps the order of the input. Stages that aggregate are
+        never batched, since each batch would get its own `final` output.
+        """
+        if not self.batched:
+            return self.request('process', objs)
+
+        serializer = self.serializer
+        out = []
+        for batch in prefetch(self.batches(objs, serializer)):
+            out.extend(self._stream('process', batch, serializer))
 
         return out
 
+    def map(self, objs):
+        """\
+        the `map` command: a list of outputs for each of objs, then a last
+        list with the output of the stage's `finish`. Batched like process;
+        every batch finishes, but only the last one's finish is kept.
+        """
+        if not self.batched:
+            return self.request('map', objs)
+
+        serializer = self.serializer
+        groups = []
+        for batch in prefetch(self.batches(objs, serializer)):
+            out = list(self._stream('map', batch, serializer))
+            finish = out.pop()
+            groups.extend(out)
+
+        groups.append(finish)
+        return groups
+
+    def close(self):
+        "stop the persistent worker, if one was started"
+        if self._worker is not None:
+            worker, self._worker = self._worker, None
+            usage = worker.close()
+
+            # requests are recorded as they go; this covers the worker's life
+            record = Record(self.label, 'serve')
+            record.start, record.spawned = worker.started, worker.spawned
+            record.finish(usage, worker.stderr)
+            self.submit(record)
+
 
 class Graph(object):
-    def __init__(self, directory, stages=None):
+    def __init__(self, directory, stages=None, probe_jobs=None, **options):
+        """\
+        build a graph of the stages in directory; options are passed to
+        Stage. Up to `probe_jobs` stages are asked for their configuration
+        at once.
+        """
         self.directory = directory
+        self.options = options
         self.stages = stages if stages is not None else [
-            Stage(f)
-            for f in files_in_dir(self.directory)
+            Stage(f, **options)
+            for f in files_in_dir(self.directory, constants.ignore_patterns)
         ]
-        self.graph = self._build_graph()
+        self.probe_jobs = probe_jobs or constants.probe_jobs
+        self._indexes = None
+
+    def configure(self):
+        """\
+        get every stage's configuration, running the probes side by side.
+        Failures are collected and raised together as a ConfigurationError.
+        """
+        unknown = [
+            stage for stage in self.stages
+            if not getattr(stage, '_configuration', None)
+        ]
+
+        def probe(stage):
+            try:
+                stage.configuration
+            except Exception as e:
+                return stage, e
+
+            return stage, None
+
+        if len(unknown) > 1 and self.probe_jobs > 1:
+            pool = ThreadPool(min(self.probe_jobs, len(unknown)))
+            try:
+                results = pool.map(probe, unknown)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [probe(stage) for stage in unknown]
+
+        errors = [(stage, e) for stage, e in results if e is not None]
+        if errors:
+            raise ConfigurationError(errors)
+
+    @property
+    def indexes(self):
+        """\
+        stages by name, the stages consuming each tag and the stages
+        producing each tag, built in one pass on first use
+        """
+        if self._indexes is None:
+            self._indexes = self._build_indexes()
+
+        return self._indexes
+
+    @property
+    def graph(self):
+        "map each tag to the stages consuming it"
+        return self.indexes[1]
+
+    def consumers(self, tag):
+        return self.indexes[1].get(tag, set())
+
+    def producers(self, tag):
+        return self.indexes[2].get(tag, set())
+
+    def reload(self, path):
+        """\
+        pick up a change to the stage file at path: drop the Stage we had
+        for it, and start a new one (asking it for its configuration again)
+        if the file is still there. Returns the stages whose output may have
+        changed because of it.
+        """
+        path = local(path)
+        old = [stage for stage in self.stages if stage.pathfile == path]
+        def known(stage, key):
+            "tags from what we know of stage's configuration, without asking"
+            return set((getattr(stage, '_configuration', None) or {}).get(key, []))
+
+        dirty = set()
+        for stage in old:
+            tags = known(stage, 'output_tags')
+            dirty.update(
+                s for s in self.stages if tags & known(s, 'input_tags')
+            )
+
+            self.stages.remove(stage)
+            stage.close()
+
+        dirty.difference_update(old)
+        if path.isfile() and not ignored(path, constants.ignore_patterns):
+            stage = Stage(path, **self.options)
+            self.stages.append(stage)
+            self.stages.sort(key=lambda s: str(s.pathfile))
+            dirty.add(stage)
+
+        self._indexes = None
+        return dirty
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+
+    def pipe(self, names, objs):
+        """\
+        stream objs through the named stages in order. Every stage runs at
+        once, each consuming its upstream's output as it is produced.
+        """
+        for name in names:
+            objs = self[name].stream('process', objs)
+
+        return objs
 
     def __getitem__(self, name):
+        try:
+            return self.indexes[0][name]
+        except KeyError:
+            raise KeyError('No stage "%s"' % name)
+
+    def _build_indexes(self):
+        self.configure()
+
+        names, consumers, producers = {}, {}, {}
         for stage in self.stages:
-            if stage.configuration['name'] == name:
-                return stage
+            config = stage.configuration
+            if config['name'] in names:
+                raise DuplicateStage('%r and %r are both named "%s"' % (
+                    names[config['name']], stage, config['name']
+                ))
 
-        raise KeyError('No stage "%s"' % name)
+            names[config['name']] = stage
+            for tag in config['output_tags']:
+                consumers.setdefault(tag, set())
+                producers.setdefault(tag, set()).add(stage)
 
+            for tag in config['input_tags']:
+                consumers.setdefault(tag, set()).add(stage)
+                producers.setdefault(tag, set())
 
-    def _build_graph(self):
-        tags = chain.from_iterable(
-            stage.configuration['output_tags'] + stage.configuration['input_tags']
-            for stage in self.stages
-        )
+        return names, consumers, producers
 
-        return {
-            name: set(
-                stage for stage in self.stages
-                if name in stage.configuration['input_tags']
-            )
-            for name in tags
-        }
+
+class Router(object):
+    """\
+    send each object a stage outputs to only the stages consuming its tags.
+    An object's tags come from its `$tag` key (one tag or a list of them),
+    which must be among the stage's output tags, or failing that from the
+    stage's output tags. The tag only addresses the edge it leaves the stage
+    on, so consumers get the object without it.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.routes = {}
+
+    def tags(self, obj):
+        "the tags obj asks to go out on, or None for all of them"
+        tags = obj.get(constants.tag_key) if isinstance(obj, dict) else None
+        if tags is None:
+            return None
+
+        return tuple(tags) if isinstance(tags, list) else (tags,)
+
+    def route(self, stage, obj):
+        "the stages that should get obj"
+        tags = self.tags(obj)
+        try:
+            return self.routes[stage, tags]
+        except KeyError:
+            pass
+
+        declared = stage.configuration['output_tags']
+        if tags is None:
+            tags = declared
+        elif not set(tags).issubset(declared):
+            raise RoutingError('%r output tags %s, but only declares %s' % (
+                stage, ', '.join(sorted(set(tags) - set(declared))),
+                ', '.join(declared) or 'none',
+            ))
+
+        consumers = set()
+        for tag in tags:
+            consumers.update(self.graph.consumers(tag))
+        consumers.discard(stage)
+
+        self.routes[stage, self.tags(obj)] = consumers
+        return consumers
+
+    def dispatch(self, stage, objs):
+        "split a stage's output into a list of objects per consuming stage"
+        queues = {}
+        for obj in objs:
+            consumers = self.route(stage, obj)
+            if consumers and self.tags(obj) is not None:
+                obj = copy(obj)
+                dict.pop(obj, constants.tag_key)
+
+            for consumer in consumers:
+                queues.setdefault(consumer, []).append(obj)
+
+        return queues
@@ -1,16 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from datetime import date, datetime
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from .utils import ClassRegistry
 
 serializers = ClassRegistry()
 
 
+class Serializer(object):
+    "common behavior for serializers; subclasses implement load and dump"
+    framing = 'line'
+
+    def dump_bytes(self, obj):
+        "dump obj, encoded for the wire"
+        dumped = self.dump(obj)
+        if isinstance(dumped, bytes):
+            return dumped
+
+        return dumped.encode('utf-8')
+
+
 @serializers.register('json')
-class JSONSerializer(object):
+class JSONSerializer(Serializer):
     "serialize to and from JSON"
+    name = 'json'
+
     class Encoder(json.JSONEncoder):
         def default(self, obj):
             if isinstance(obj, datetime):
@@ -19,6 +44,9 @@ class JSONSerializer(object):
             return json.JSONEncoder.default(self, obj)
 
     def load(self, serialized):
+        if isinstance(serialized, memoryview):
+            serialized = serialized.tobytes()
+
         try:
             serialized = serialized.decode('utf-8')
         except AttributeError: # already a str/unicode
@@ -28,3 +56,57 @@ class JSONSerializer(object):
 
     def dump(self, obj):
         return json.dumps(obj, cls=self.Encoder)
+
+
+@serializers.register('fastjson')
+class FastJSONSerializer(JSONSerializer):
+    """\
+    JSON, through orjson when it's installed. The wire format is the same as
+    the json serializer, so either side can fall back to plain json.
+    """
+    name = 'fastjson'
+
+    def load(self, serialized):
+        if orjson is None:
+            return JSONSerializer.load(self, serialized)
+
+        return orjson.loads(serialized)
+
+    def dump(self, obj):
+        if orjson is None:
+            return JSONSerializer.dump(self, obj)
+
+        return orjson.dumps(obj, default=self._default).decode('utf-8')
+
+    def dump_bytes(self, obj):
+        if orjson is None:
+            return JSONSerializer.dump_bytes(self, obj)
+
+        # skip decoding just to encode again
+        return orjson.dumps(obj, default=self._default)
+
+    def _default(self, obj):
+        return self.Encoder().default(obj)
+
+
+if msgpack is not None:
+    @serializers.register('msgpack')
+    class MsgpackSerializer(Serializer):
+        """\
+        serialize to and from msgpack, with length-prefixed framing so
+        objects can carry raw bytes (images and such) without base64
+        """
+        name = 'msgpack'
+        framing = 'length'
+
+        def _default(self, obj):
+            if isinstance(obj, (date, datetime)):
+                return obj.isoformat()
+
+            raise TypeError('Cannot serialize %r' % obj)
+
+        def load(self, serialized):
+            return msgpack.unpackb(serialized, raw=False)
+
+        def dump(self, obj):
+            return msgpack.packb(obj, default=self._default, use_bin_type=True)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+from itertools import groupby
+import os
+import shutil
+import tempfile
+
+from .config import constants
+from .framing import framings
+from .serializers import serializers
+
+
+class ExternalSort(object):
+    """\
+    collect objects and give them back sorted by `key`, holding at most
+    `limit` of them in memory. Past that, sorted runs are written to
+    temporary files and merged back when the objects are read, so
+    collectors can aggregate more than fits in memory. Objects that go to
+    disk come back through `serializer`, and `load` (if given) is called on
+    each of them.
+    """
+    def __init__(self, key=None, limit=None, serializer=None, load=None,
+                 directory=None):
+        self.key = key or (lambda obj: obj)
+        self.limit = limit or constants.sort_buffer
+        self.serializer = serializer or serializers[constants.default_serializer]()
+        self.framing = framings[self.serializer.framing]()
+        self.load = load
+        self.parent = directory
+        self.directory = None
+        self.buffer = []
+        self.runs = []
+
+    def __len__(self):
+        return len(self.buffer) + sum(n for _, n in self.runs)
+
+    def add(self, obj):
+        self.buffer.append(obj)
+        if len(self.buffer) >= self.limit:
+            self.spill()
+
+    def extend(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def spill(self):
+        "write the buffer out as a sorted run"
+        if not self.buffer:
+            return
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='perch-sort-', dir=self.parent)
+
+        self.buffer.sort(key=self.key)
+        path = os.path.join(self.directory, '%d.run' % len(self.runs))
+        with open(path, 'wb') as f:
+            for obj in self.buffer:
+                f.write(self.framing.frame(self.serializer.dump_bytes(obj)))
+
+        self.runs.append((path, len(self.buffer)))
+        self.buffer = []
+
+    def read(self, run):
+        "(key, run, position, object) for each object in a run"
+        path, _ = self.runs[run]
+        with open(path, 'rb') as f:
+            payloads = self.framing.frames(f, until_empty=False)
+            for n, payload in enumerate(payloads):
+                obj = self.serializer.load(payload)
+                if self.load:
+                    obj = self.load(obj)
+
+                # run and position break ties, so objects are never compared
+                yield self.key(obj), run, n, obj
+
+    def __iter__(self):
+        "every object so far, sorted by key (stable for equal keys)"
+        if not self.runs:
+            for obj in sorted(self.buffer, key=self.key):
+                yield obj
+
+            return
+
+        # keys have to be worked out the same way for every object (a
+        # datetime doesn't come back from JSON as one), so everything is
+        # merged from disk
+        self.spill()
+        merged = heapq.merge(*[self.read(run) for run in range(len(self.runs))])
+        for _, _, _, obj in merged:
+            yield obj
+
+    def groups(self):
+        "(key, objects) for each distinct key, in order"
+        for key, objs in groupby(self, self.key):
+            yield key, list(objs)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+        self.buffer = []
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+from .config import constants
+
+HANDLE_KEY = '$spool'
+
+
+def is_handle(value):
+    return isinstance(value, dict) and HANDLE_KEY in value
+
+
+def plain(obj):
+    "obj with any spooled fields read back, for keeping past the spool's life"
+    if isinstance(obj, SpooledObject):
+        return obj.spool.resolved(obj)
+
+    return obj
+
+
+class Spool(object):
+    """\
+    move big fields (`content`, by default) out of serialized objects and
+    into an append-only file, leaving a small handle in their place. Handles
+    go through serializers and from stage to stage untouched, and the data
+    is only read (through mmap) when someone asks for the field.
+
+    Every process writes to its own files in a shared directory, which is
+    on /dev/shm when there is one so the data never hits the disk. A new
+    file is started on `rotate`, so the data written between two rotations
+    can be dropped as a whole once nothing points at it (see `collect`.)
+    """
+    def __init__(self, directory=None, threshold=None, fields=None):
+        self.owned = directory is None
+        if self.owned:
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            directory = tempfile.mkdtemp(prefix='perch-spool-', dir=shm)
+
+        self.directory = str(directory)
+        self.threshold = threshold or constants.spool_threshold
+        self.fields = fields or constants.spool_fields
+        self.lock = Lock()
+        self.fd = None
+        self.path = None
+        self.offset = 0
+        self.maps = {}
+
+    def put(self, data):
+        "write data to the spool, returning a handle to it"
+        encoding = None
+        if not isinstance(data, bytes):
+            data, encoding = data.encode('utf-8'), 'utf-8'
+
+        with self.lock:
+            if self.fd is None:
+                fd, self.path = tempfile.mkstemp(dir=self.directory, suffix='.spool')
+                self.fd = fd
+
+            offset = self.offset
+            # unbuffered, so the data is visible to readers right away
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+
+            self.offset += len(data)
+
+        return {HANDLE_KEY: self.path, 'offset': offset, 'length': len(data),
+                'encoding': encoding}
+
+    def get(self, handle):
+        "read the data behind a handle"
+        path, offset = handle[HANDLE_KEY], handle['offset']
+        end = offset + handle['length']
+
+        with self.lock:
+            mapped = self.maps.get(path)
+            if mapped is None or len(mapped) < end:
+                # the file grew since we mapped it
+                if mapped is not None:
+                    mapped.close()
+
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[path] = mapped
+
+            data = mapped[offset:end]
+
+        if handle.get('encoding'):
+            return data.decode(handle['encoding'])
+
+        return data
+
+    def spill(self, obj):
+        "replace obj's big fields (or those of each object in a list) with handles"
+        if isinstance(obj, list):  # a group of `map` output
+            return [self.spill(o) for o in obj]
+
+        if not isinstance(obj, dict):
+            return obj
+
+        spilled = None
+        for field in self.fields:
+            value = dict.get(obj, field)
+            if isinstance(value, (bytes, type(u''))) and len(value) >= self.threshold:
+                spilled = spilled or dict(obj)
+                spilled[field] = self.put(value)
+
+        if spilled is None:
+            return obj
+
+        return SpooledObject(self, spilled)
+
+    def lazy(self, obj):
+        "wrap obj (or each object in a list) so handles are resolved when read"
+        if isinstance(obj, list):
+            return [self.lazy(o) for o in obj]
+
+        if isinstance(obj, dict) and any(is_handle(v) for v in obj.values()):
+            return SpooledObject(self, obj)
+
+        return obj
+
+    def resolved(self, obj):
+        "a plain copy of obj with every handle read back"
+        if not isinstance(obj, dict):
+            return obj
+
+        return dict(
+            (k, self.get(v) if is_handle(v) else v)
+            for k, v in dict.items(obj)
+        )
+
+    def rotate(self):
+        "write whatever comes next to a new file"
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd, self.path, self.offset = None, None, 0
+
+    def collect(self, keep):
+        """\
+        remove the files in the spool that none of the objects in keep have
+        fields in. Only call this while nobody is writing to the spool (in
+        between builds, say), since the files other processes are writing to
+        can't be told apart from garbage.
+        """
+        self.rotate()
+        referenced = set(
+            value[HANDLE_KEY]
+            for obj in keep if isinstance(obj, dict)
+            for value in dict.values(obj) if is_handle(value)
+        )
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path not in referenced and name.endswith('.spool'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.rotate()
+
+        if self.owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SpooledObject(dict):
+    """\
+    a dict whose spooled fields are read when they're accessed. Serializers
+    see the raw handles, so passing the object on copies no data.
+    """
+    def __init__(self, spool, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.spool = spool
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if is_handle(value):
+            value = self.spool.get(value)
+
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from fnmatch import fnmatch
 from py.path import local
 import os
+from threading import Thread
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 class ClassRegistry(dict):
     "hold and register classes by nickname, to select later"
@@ -12,7 +18,41 @@ class ClassRegistry(dict):
 
         return inner
 
-def files_in_dir(target):
-    for l in local(target).visit(sort=True):
-        if l.isfile():
+def ignored(path, patterns):
+    return any(fnmatch(path.basename, pattern) for pattern in patterns)
+
+def files_in_dir(target, ignore=()):
+    "files under target, skipping anything whose name matches an ignore pattern"
+    for l in local(target).visit(
+        rec=lambda d: not ignored(d, ignore), sort=True
+    ):
+        if l.isfile() and not ignored(l, ignore):
             yield l
+
+def prefetch(iterable, size=1):
+    """\
+    iterate over iterable from a background thread, keeping up to `size`
+    items ready ahead of the consumer
+    """
+    done = object()
+    queue = Queue(maxsize=size)
+    failure = []
+
+    def fill():
+        try:
+            for item in iterable:
+                queue.put(item)
+        except Exception as e:
+            failure.append(e)
+        finally:
+            queue.put(done)
+
+    filler = Thread(target=fill)
+    filler.daemon = True
+    filler.start()
+
+    for item in iter(queue.get, done):
+        yield item
+
+    if failure:
+        raise failure[0]
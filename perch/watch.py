@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+from fnmatch import fnmatch
+import os
+from select import select
+import struct
+import time
+
+from .config import constants
+from .utils import files_in_dir
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (AttributeError, OSError, TypeError):
+    libc = None
+
+
+def skipped(root, path):
+    "whether path, somewhere under root, is in an ignored file or directory"
+    relative = os.path.relpath(path, root)
+    return any(
+        fnmatch(part, pattern)
+        for part in relative.split(os.sep)
+        for pattern in constants.ignore_patterns
+    )
+
+
+class PollingWatcher(object):
+    "notice changed files by comparing mtimes and sizes every so often"
+    def __init__(self, paths, interval=None):
+        self.paths = [os.path.abspath(str(path)) for path in paths]
+        self.interval = interval or constants.watch_interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        for root in self.paths:
+            for f in files_in_dir(root, constants.ignore_patterns):
+                try:
+                    stat = os.stat(str(f))
+                except OSError:  # gone already
+                    continue
+
+                state[str(f)] = (stat.st_mtime, stat.st_size)
+
+        return state
+
+    def changes(self, timeout=None):
+        """\
+        the files changed, added or removed since we last looked, waiting up
+        to `timeout` seconds (or for good) for there to be some
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            state = self.snapshot()
+            changed = set(
+                path for path in set(state) | set(self.state)
+                if state.get(path) != self.state.get(path)
+            )
+            self.state = state
+
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """\
+    notice changed files as they happen, through Linux's inotify. Events
+    are gathered until things have been quiet for `settle` seconds, so an
+    editor saving a file in several steps counts as one change.
+    """
+    event = struct.Struct('iIII')
+    CLOSE_WRITE, MOVED_FROM, MOVED_TO = 0x8, 0x40, 0x80
+    CREATE, DELETE, OVERFLOW, ISDIR = 0x100, 0x200, 0x4000, 0x40000000
+    MASK = CLOSE_WRITE | MOVED_FROM | MOVED_TO | CREATE | DELETE
+
+    def __init__(self, paths, settle=None):
+        self.paths = [os.path.abspath(str(path)) for path in paths]
+        self.settle = settle or constants.watch_settle
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches = {}
+        for root in self.paths:
+            self.watch_tree(root, root)
+
+    def watch(self, root, directory):
+        wd = libc.inotify_add_watch(
+            self.fd, directory.encode('utf-8'), self.MASK
+        )
+        if wd >= 0:
+            self.watches[wd] = (root, directory)
+
+    def watch_tree(self, root, directory):
+        "watch directory and everything under it, returning the files there"
+        found = set()
+        for base, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not skipped(root, os.path.join(base, d))]
+            self.watch(root, base)
+            found.update(
+                os.path.join(base, f) for f in files
+                if not skipped(root, os.path.join(base, f))
+            )
+
+        return found
+
+    def read(self):
+        "changed paths in the events waiting for us"
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError:  # nothing after all
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = data[offset:offset + size].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += size
+
+            if mask & self.OVERFLOW:
+                # we missed some; say everything changed
+                for root in self.paths:
+                    changed.update(
+                        str(f) for f in files_in_dir(root, constants.ignore_patterns)
+                    )
+                continue
+
+            if wd not in self.watches or not name:
+                continue
+
+            root, directory = self.watches[wd]
+            path = os.path.join(directory, name)
+            if skipped(root, path):
+                continue
+
+            if mask & self.ISDIR:
+                if mask & (self.CREATE | self.MOVED_TO):
+                    changed.update(self.watch_tree(root, path))
+                continue
+
+            changed.add(path)
+
+        return changed
+
+    def changes(self, timeout=None):
+        """\
+        the files changed, added or removed since we last looked, waiting up
+        to `timeout` seconds (or for good) for there to be some
+        """
+        if not select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        changed = self.read()
+        while select([self.fd], [], [], self.settle)[0]:
+            changed.update(self.read())
+
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watcher(paths, interval=None):
+    "an InotifyWatcher where we can have one, and a PollingWatcher otherwise"
+    if libc is not None:
+        try:
+            return InotifyWatcher(paths)
+        except OSError:  # out of watches, most likely
+            pass
+
+    return PollingWatcher(paths, interval)
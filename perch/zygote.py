@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""\
+start Python stages by forking them from a warm interpreter (a zygote)
+that has already imported the heavy modules they share, instead of paying
+for a fresh interpreter and those imports on every run.
+
+The zygote is this module run with ``python -m perch.zygote``. It gets
+requests over a Unix socket, each carrying the stage's arguments and
+environment and, as SCM_RIGHTS, the pipes to use as its stdin, stdout and
+stderr plus one more for reporting back. For each request it forks a
+monitor, which forks the stage and writes the stage's pid and then its
+exit status to that last pipe.
+"""
+import array
+import json
+import os
+import re
+from select import select
+from shlex import split
+import signal
+import socket
+import struct
+from subprocess import Popen
+import sys
+from threading import Lock
+import traceback
+
+available = hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork') and \
+    hasattr(socket.socket, 'sendmsg')
+
+HEADER = struct.Struct('>I')
+FDS = 4  # stdin, stdout, stderr, status
+
+
+def interpreter(runner):
+    "the Python interpreter runner runs, or None if it runs something else"
+    args = split(runner)
+    if args and os.path.basename(args[0]) == 'env':
+        args = args[1:]
+
+    if len(args) == 1 and re.match(r'python[\d.]*$', os.path.basename(args[0])):
+        return args[0]
+
+    return None
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+
+        data += chunk
+
+    return data
+
+
+def receive(sock):
+    "read one request and its file descriptors, or (None, []) at the end"
+    fds = array.array('i')
+    header, ancillary, _, _ = sock.recvmsg(
+        HEADER.size, socket.CMSG_LEN(FDS * fds.itemsize)
+    )
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+
+    if len(header) < HEADER.size:
+        header += _recv_exactly(sock, HEADER.size - len(header)) or b''
+        if len(header) < HEADER.size:
+            return None, list(fds)
+
+    size, = HEADER.unpack(header)
+    body = _recv_exactly(sock, size)
+    if body is None:
+        return None, list(fds)
+
+    return json.loads(body.decode('utf-8')), list(fds)
+
+
+# the zygote's side
+
+def execute(request, stdin, stdout, stderr):
+    "become the stage: run its script as __main__ and exit with its status"
+    for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.argv = request['argv']
+    # like `python script.py`: the script's directory comes first, so
+    # helpers next to it import and nothing in the cwd shadows them
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+    code = 0
+    try:
+        import runpy
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write('%s\n' % e.code)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    for f in (sys.stdout, sys.stderr):
+        try:
+            f.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+    os._exit(code)
+
+
+def monitor(request, fds):
+    "fork the stage, then report its pid and exit status"
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    stdin, stdout, stderr, status = fds
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(status)
+        execute(request, stdin, stdout, stderr)
+
+    for fd in (stdin, stdout, stderr):
+        os.close(fd)
+
+    os.write(status, ('%d\n' % pid).encode('ascii'))
+    _, result = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(result):
+        code = -os.WTERMSIG(result)
+    else:
+        code = os.WEXITSTATUS(result)
+
+    os.write(status, ('%d\n' % code).encode('ascii'))
+
+
+def serve(sock, preload=()):
+    "fork a stage for every request on sock, until it closes"
+    for name in preload:
+        try:
+            __import__(name)
+        except Exception:
+            sys.stderr.write('perch zygote: could not preload %s\n' % name)
+            traceback.print_exc()
+
+    # monitors are never waited for
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        request, fds = receive(sock)
+        if request is None or len(fds) != FDS:
+            for fd in fds:
+                os.close(fd)
+
+            if request is None:
+                break
+
+            continue
+
+        if os.fork() == 0:
+            code = 1
+            try:
+                sock.close()
+                monitor(request, fds)
+                code = 0
+            finally:
+                os._exit(code)
+
+        for fd in fds:
+            os.close(fd)
+
+
+# the router's side
+
+class Forked(object):
+    """\
+    a stage forked by a zygote. It isn't our child, so it has just enough
+    of Popen's interface for Stage and Worker, with the exit status coming
+    from the zygote's monitor.
+    """
+    def __init__(self, zygote, argv, env=None):
+        ours, theirs = [], []
+        for reader in (False, True, True, True):  # stdin, stdout, stderr, status
+            r, w = os.pipe()
+            ours.append(r if reader else w)
+            theirs.append(w if reader else r)
+
+        try:
+            zygote.send({
+                'argv': argv,
+                'env': dict(os.environ if env is None else env),
+                'cwd': os.getcwd(),
+            }, theirs)
+        except (IOError, OSError):
+            for fd in ours:
+                os.close(fd)
+            raise
+        finally:
+            for fd in theirs:
+                os.close(fd)
+
+        self.stdin = os.fdopen(ours[0], 'wb')
+        self.stdout = os.fdopen(ours[1], 'rb')
+        self.stderr = os.fdopen(ours[2], 'rb')
+        self.status = os.fdopen(ours[3], 'rb')
+        self.returncode = None
+
+        pid = self.status.readline()
+        if not pid:
+            self.close()
+            raise OSError('The zygote did not start %s' % argv[0])
+
+        self.pid = int(pid)
+
+    def close(self):
+        for f in (self.stdin, self.stdout, self.stderr, self.status):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def _finish(self, line):
+        # no status means the monitor died, taking the stage with it
+        self.returncode = int(line) if line.strip() else -signal.SIGKILL
+        self.status.close()
+
+    def poll(self):
+        if self.returncode is None and select([self.status], [], [], 0)[0]:
+            self._finish(self.status.readline())
+
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self._finish(self.status.readline())
+
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class Zygote(object):
+    "a warm interpreter, started with `runner`, that forks stages on request"
+    def __init__(self, runner, preload=()):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.process = Popen(
+                split(runner) + ['-m', 'perch.zygote', str(theirs.fileno())] +
+                list(preload),
+                pass_fds=(theirs.fileno(),),
+            )
+        finally:
+            theirs.close()
+
+        self.sock = ours
+        self.lock = Lock()
+
+    def send(self, request, fds):
+        body = json.dumps(request).encode('utf-8')
+        with self.lock:
+            # the descriptors ride along with the first bytes, so a request
+            # never gets another one's
+            self.sock.sendmsg(
+                [HEADER.pack(len(body)) + body],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))],
+            )
+
+    def spawn(self, argv, env=None):
+        return Forked(self, argv, env)
+
+    def close(self):
+        self.sock.close()
+        self.process.wait()
+
+
+class Zygotes(object):
+    """\
+    one Zygote per Python interpreter our stages run with, started when a
+    stage first needs it. Stages run by anything else aren't ours to start.
+    """
+    def __init__(self, preload=()):
+        self.preload = ['perch.bases'] + list(preload)
+        self.zygotes = {}
+        self.broken = set()
+        self.lock = Lock()
+
+    def fits(self, runner):
+        return available and interpreter(runner) is not None and \
+            runner not in self.broken
+
+    def spawn(self, runner, argv, env=None):
+        """\
+        fork a stage from runner's zygote. If that fails (the interpreter
+        can't import perch, say) the runner isn't tried again.
+        """
+        with self.lock:
+            zygote = self.zygotes.get(runner)
+            if zygote is None or zygote.process.poll() is not None:
+                zygote = self.zygotes[runner] = Zygote(runner, self.preload)
+
+        try:
+            return zygote.spawn(argv, env)
+        except (IOError, OSError):
+            with self.lock:
+                self.broken.add(runner)
+            raise
+
+    def close(self):
+        with self.lock:
+            zygotes, self.zygotes = self.zygotes, {}
+
+        for zygote in zygotes.values():
+            zygote.close()
+
+
+def main(argv=None):
+    argv = argv or sys.argv
+    sock = socket.socket(fileno=int(argv[1]))
+    serve(sock, argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,15 @@ setup(
     install_requires=[
         "py >= 1.4.17",
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'msgpack': ['msgpack'],
+    },
+    entry_points={
+        'console_scripts': [
+            'perch = perch.cli:main',
+        ],
+    },
     license="BSD",
     zip_safe=False,
     keywords='perch',
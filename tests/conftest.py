@@ -1,6 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import pytest
+import sys
+
+# async syntax doesn't even parse before 3.5, so importorskip is too late
+collect_ignore = ['test_aio.py'] if sys.version_info < (3, 5) else []
+
+@pytest.fixture
+def importable(monkeypatch):
+    "make perch importable from stage subprocesses"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv('PYTHONPATH', root)
 
 def pytest_runtest_makereport(item, call):
     if "incremental" in item.keywords:
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from perch.errors import BadExit
+from perch.router import Stage
+from perch.serializers import serializers
+
+from .test_executor import graph
+from .test_router import handler_content
+
+aio = pytest.importorskip('perch.aio')
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+@pytest.fixture
+def stage(tmpdir, importable):
+    f = tmpdir.join('echo.py')
+    f.write(handler_content('echo', ['in'], ['out']))
+    return aio.AsyncStage(Stage(f))
+
+
+class TestRead(object):
+    def read_all(self, framing, data, limit=2 ** 16):
+        async def inner():
+            reader = asyncio.StreamReader(limit=limit)
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [p async for p in aio.payloads(framing, reader)]
+
+        return run(inner())
+
+    def test_lines(self):
+        framing = aio.framings['line']()
+        assert self.read_all(framing, b'a\n\nb') == [b'a', b'b']
+
+    def test_long_line(self):
+        framing = aio.framings['line']()
+        assert self.read_all(framing, b'x' * 100 + b'\ny\n', limit=16) == \
+            [b'x' * 100, b'y']
+
+    def test_length(self):
+        framing = aio.framings['length']()
+        data = framing.frame(b'a\nb') + framing.frame(b'') + framing.frame(b'c')
+        assert self.read_all(framing, data) == [b'a\nb', b'c']
+
+    def test_length_truncated(self):
+        framing = aio.framings['length']()
+        assert self.read_all(framing, framing.frame(b'abc')[:-1]) == []
+
+
+class TestAsyncStage(object):
+    def test_configure(self, stage):
+        config = run(stage.configure())
+        assert config['name'] == 'echo'
+        assert stage.stage.configuration is config
+
+    def test_process(self, stage):
+        out = run(stage.process([{'n': 1}, {'n': 2}]))
+        assert [o['n'] for o in out] == [1, 2]
+
+    def test_process_async_iterable(self, stage):
+        async def objs():
+            for n in range(3):
+                yield {'n': n}
+
+        out = run(stage.process(objs()))
+        assert [o['n'] for o in out] == [0, 1, 2]
+
+    def test_stream_stops_early(self, stage):
+        async def first():
+            stream = stage.stream('process', [{'n': 1}, {'n': 2}])
+            try:
+                return await stream.__anext__()
+            finally:
+                await stream.aclose()
+
+        assert run(first())['n'] == 1
+
+    def test_nonzero_exit_code(self, stage):
+        with pytest.raises(BadExit):
+            run(stage.process([{'exit': 3}]))
+
+    @pytest.mark.skipif('msgpack' not in serializers, reason='needs msgpack')
+    def test_negotiated_serializer(self, tmpdir, importable):
+        f = tmpdir.join('echo.py')
+        f.write(handler_content('echo', ['in'], ['out']))
+        stage = aio.AsyncStage(Stage(f, formats=['msgpack']))
+
+        run(stage.configure())
+        assert stage.stage.serializer.name == 'msgpack'
+        assert run(stage.process([{'n': b'\x00'}]))[0]['n'] == b'\x00'
+
+
+class TestAsyncExecutor(object):
+    def test_chain(self, graph):
+        out = run(aio.AsyncExecutor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b']), ('c', ['b'], ['c']),
+        )).run())
+
+        assert [o['path'] for o in out['c']] == [['a', 'b', 'c']]
+
+    def test_initial(self, graph):
+        out = run(aio.AsyncExecutor(graph(('a', ['src'], ['a']))).run({
+            'src': [{'path': [], 'times': {}}],
+        }))
+
+        assert out['a'][0]['path'] == ['a']
+
+    def test_siblings_overlap(self, graph):
+        out = run(aio.AsyncExecutor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b'], 0.5), ('c', ['a'], ['c'], 0.5),
+        )).run())
+
+        (b_start, b_end), = [o['times']['b'] for o in out['b']]
+        (c_start, c_end), = [o['times']['c'] for o in out['c']]
+        assert b_start < c_end and c_start < b_end
+
+    def test_jobs_limit(self, graph):
+        out = run(aio.AsyncExecutor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b'], 0.3), ('c', ['a'], ['c'], 0.3),
+        ), jobs=1).run())
+
+        (b_start, b_end), = [o['times']['b'] for o in out['b']]
+        (c_start, c_end), = [o['times']['c'] for o in out['c']]
+        assert b_end <= c_start or c_end <= b_start
+
+    def test_failure_stops_dependents(self, graph):
+        executor = aio.AsyncExecutor(graph(
+            ('a', ['src'], ['a']), ('b', ['a'], ['b']),
+        ))
+
+        with pytest.raises(BadExit):
+            run(executor.run({'src': [{'path': [], 'times': {}, 'fail': 'a'}]}))
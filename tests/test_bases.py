@@ -4,9 +4,16 @@ try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+from io import BytesIO
+import multiprocessing
+import os
 import pytest
+import threading
+import time
 
-from perch.bases import StdIOHandler, Collector, Renderer
+from perch.bases import StdIOHandler, Collector, FrameWriter, Renderer
+from perch.config import Settings, constants
+from perch.framing import LengthFraming
 
 @pytest.fixture
 def stubbedio():
@@ -69,6 +76,10 @@ class TestStdIOHandler(object):
             'name': stubbedio.name,
             'input_tags': stubbedio.input_tags,
             'output_tags': stubbedio.output_tags,
+            'commands': ['config', 'process', 'start', 'serve'],
+            'aggregates': False,
+            'serializers': stubbedio.serializers(),
+            'dependencies': [],
         })
 
     # test run
@@ -96,8 +107,166 @@ class TestStdIOHandler(object):
 
         assert err == 'Cannot do "blah"\n'
 
+    # test serve
+    def test_serve(self, stubbedconv):
+        requests = BytesIO(
+            b'{"command": "process"}\n'
+            b'{"filename": "a.txt"}\n'
+            b'\n'
+            b'{"command": "config"}\n'
+            b'\n'
+        )
+        out = BytesIO()
+        stubbedconv.serve(requests, out)
+
+        assert out.getvalue().decode('utf-8') == (
+            self.serialize(stubbedconv.serializer, [
+                {'msg': {'filename': 'a.txt'}}, {'msg': 'finish'},
+            ]) + '\n' + stubbedconv.get_configuration() + '\n\n'
+        )
+
+    def test_serve_length_framed(self, stubbedconv):
+        framing = stubbedconv.framing = LengthFraming()
+        requests = BytesIO(
+            framing.frame(b'{"command": "process"}') +
+            framing.frame(b'{"filename": "a\\nb.txt"}') +
+            framing.frame(b'')
+        )
+        out = BytesIO()
+        stubbedconv.serve(requests, out)
+        out.seek(0)
+
+        assert [stubbedconv.serializer.load(p) for p in framing.frames(out)] == [
+            {'msg': {'filename': 'a\nb.txt'}}, {'msg': 'finish'},
+        ]
+        assert framing.read(out) is None
+
+    def test_serve_skips_unread_input(self, stubbedio):
+        requests = BytesIO(
+            b'{"command": "process"}\n'
+            b'{"filename": "a.txt"}\n'
+            b'\n'
+            b'{"command": "start"}\n'
+            b'\n'
+        )
+        out = BytesIO()
+        stubbedio.serve(requests, out)
+
+        assert out.getvalue().decode('utf-8') == (
+            self.serialize(stubbedio.serializer, stubbedio.process(None)) + '\n' +
+            self.serialize(stubbedio.serializer, stubbedio.start()) + '\n'
+        )
+
+
+class Writes(BytesIO):
+    "a file that counts the writes and flushes it gets"
+    writes = 0
+    flushes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return BytesIO.write(self, data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestFrameWriter(object):
+    def test_buffers_until_size(self):
+        out = Writes()
+        writer = FrameWriter(out, size=10)
+        for _ in range(4):
+            writer.write(b'abc\n')
+
+        assert (out.writes, out.getvalue()) == (1, b'abc\n' * 3)
+
+        writer.drain()
+        assert (out.writes, out.flushes) == (2, 0)
+        assert out.getvalue() == b'abc\n' * 4
+
+    def test_flush(self):
+        out = Writes()
+        writer = FrameWriter(out)
+        writer.write(b'a\n')
+        writer.flush()
+
+        assert (out.getvalue(), out.flushes) == (b'a\n', 1)
+
+    def test_flushes_in_background(self):
+        out = Writes()
+        writer = FrameWriter(out, interval=0.01)
+        writer.start()
+        writer.write(b'a\n')
+        time.sleep(0.1)
+        writer.close()
+
+        assert (out.getvalue(), out.flushes) == (b'a\n', 1)
+
+    def test_respond_batches_writes(self, stubbedio):
+        out = Writes()
+        stubbedio.respond('process', None, out)
+
+        assert out.writes == 1
+        assert out.getvalue().count(b'\n') == 3
+
+
+class TestMapping(object):
+    def test_map_groups_by_input(self, stubbedconv, messages):
+        assert list(stubbedconv.map(messages)) == [
+            [{'msg': {'filename': 'a.txt'}}],
+            [{'msg': {'filename': 'b.txt'}}],
+            [{'msg': {'filename': 'c.txt'}}],
+            [{'msg': 'finish'}],
+        ]
+
+    def test_map_command(self, renderer, messages):
+        out = BytesIO()
+        renderer.respond('map', messages, out)
+
+        assert [renderer.serializer.load(l) for l in out.getvalue().splitlines()] == \
+               [[{'filename': 'path/to/a.txt', 'content': 'test content'}]] * 3 + [[]]
+
+    def test_map_unsupported(self, stubbedio):
+        assert not stubbedio.respond('map', None, BytesIO())
+
+    def test_advertises_aggregates(self, stubbedconv):
+        config = stubbedconv.serializer.load(stubbedconv.get_configuration())
+
+        assert config['aggregates']
+        assert 'map' in config['commands']
+
+
+class Trickle(object):
+    "a stream that remembers how far it has been read"
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.read = 0
+
+    def readline(self):
+        if self.read == len(self.lines):
+            return b''
+
+        self.read += 1
+        return self.lines[self.read - 1]
+
 
 class TestCollector(object):
+    def test_process_reads_lazily(self, stubbedconv):
+        stream = Trickle([b'{"n": 1}\n', b'{"n": 2}\n', b'{"n": 3}\n'])
+        messages = stubbedconv.process(stream)
+
+        assert next(messages) == {'msg': {'n': 1}}
+        assert stream.read == 1
+
+    def test_process_flushes_while_working(self, stubbedconv, monkeypatch):
+        monkeypatch.setattr(
+            'perch.bases.constants', Settings(constants, flush_interval=0)
+        )
+        out = Writes()
+        stubbedconv.respond('process', BytesIO(b'{"n": 1}\n{"n": 2}\n'), out)
+
+        assert out.flushes == 3
+
     def test_process_starts_with_parse(self, stubbedconv, messages):
         messages = stubbedconv.process(messages)
 
@@ -108,7 +277,115 @@ class TestCollector(object):
         message = list(stubbedconv.process(messages))[-1]
         assert {'msg': 'finish'} == message
 
+    def test_sorter(self, stubbedconv, messages):
+        sorter = stubbedconv.sorter(lambda obj: obj['filename'], limit=2)
+        sorter.extend(reversed(list(stubbedconv.objects(messages))))
+
+        assert sorter.serializer is stubbedconv.serializer
+        assert [o['filename'] for o in sorter] == ['a.txt', 'b.txt', 'c.txt']
+        sorter.close()
+
 def test_renderer(renderer, messages):
     for item in renderer.process(messages):
         assert item['filename'] == 'path/to/a.txt'
         assert item['content'] == 'test content'
+
+
+class TestMemoizedRenderer(object):
+    @pytest.fixture
+    def renderer(self, tmpdir, monkeypatch):
+        monkeypatch.setenv('PERCH_CONFIG', '{"render_cache": "%s"}' % tmpdir)
+
+        class Counting(Renderer):
+            memoize = True
+            renders = 0
+
+            def render(self, obj):
+                self.renders += 1
+                return obj['filename'], 'rendered %s' % obj['filename']
+
+        return Counting()
+
+    def test_hit_skips_render(self, renderer, messages):
+        first = list(renderer.process(messages))
+        messages.seek(0)
+        second = list(renderer.process(messages))
+
+        assert first == second
+        assert renderer.renders == 3
+
+    def test_dependency_changed(self, renderer, messages, tmpdir):
+        template = tmpdir.join('page.html')
+        template.write('one')
+        renderer.dependencies = [str(template)]
+        list(renderer.process(messages))
+
+        template.write('two')
+        renderer._memo = None
+        messages.seek(0)
+        list(renderer.process(messages))
+
+        assert renderer.renders == 6
+
+
+class PageRenderer(Renderer):
+    "renders in worker processes, so it has to be importable"
+    workers = 2
+    chunksize = 1
+
+    def render(self, obj):
+        return obj['filename'], '%s from %s' % (obj['filename'], os.getpid())
+
+
+class TestParallelRenderer(object):
+    def pages(self, n):
+        return BytesIO(b''.join(
+            ('{"filename": "%d.html"}\n' % i).encode('utf-8') for i in range(n)
+        ))
+
+    def test_process_ordered(self):
+        out = list(PageRenderer().process(self.pages(20)))
+
+        assert [o['filename'] for o in out] == ['%d.html' % i for i in range(20)]
+        assert str(os.getpid()) not in out[0]['content']
+
+    def test_process_unordered(self):
+        renderer = PageRenderer()
+        renderer.ordered = False
+        out = list(renderer.process(self.pages(20)))
+
+        assert sorted(o['filename'] for o in out) == \
+            sorted('%d.html' % i for i in range(20))
+
+    def test_map(self):
+        out = list(PageRenderer().map(self.pages(3)))
+
+        assert [[o['filename'] for o in group] for group in out] == \
+            [['0.html'], ['1.html'], ['2.html'], []]
+
+    def test_serial_without_fork(self, monkeypatch):
+        monkeypatch.setattr('perch.bases._fork_context', lambda: None)
+        out = list(PageRenderer().process(self.pages(3)))
+
+        assert [o['filename'] for o in out] == ['0.html', '1.html', '2.html']
+        assert all(str(os.getpid()) in o['content'] for o in out)
+
+    @pytest.mark.skipif(
+        not hasattr(os, 'fork') or
+        not hasattr(multiprocessing, 'set_start_method'),
+        reason='needs fork, and start methods to choose from',
+    )
+    def test_forks_whatever_the_default(self, request):
+        method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+        request.addfinalizer(
+            lambda: multiprocessing.set_start_method(method, force=True)
+        )
+
+        # spawned workers would need the renderer, lock and all, pickled
+        renderer = PageRenderer()
+        renderer.lock = threading.Lock()
+        out = list(renderer.process(self.pages(3)))
+
+        assert [o['filename'] for o in out] == ['0.html', '1.html', '2.html']
+        assert str(os.getpid()) not in out[0]['content']
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from perch.cache import ConfigCache, RenderCache
+from perch.router import Stage
+
+from .test_router import content
+
+@pytest.fixture
+def cache(tmpdir):
+    return ConfigCache(tmpdir.join('.perch-cache'))
+
+@pytest.fixture
+def stagefile(tmpdir):
+    f = tmpdir.join('stages', 'a.py')
+    f.ensure()
+    f.write(content('a', ['x'], ['y']))
+    return f
+
+
+class TestConfigCache(object):
+    def test_miss(self, cache, stagefile):
+        assert cache.get(Stage(stagefile)) is None
+
+    def test_hit(self, cache, stagefile):
+        cache.set(Stage(stagefile), {'name': 'cached'})
+
+        assert cache.get(Stage(stagefile)) == {'name': 'cached'}
+
+    def test_touched_but_unchanged(self, cache, stagefile):
+        cache.set(Stage(stagefile), {'name': 'cached'})
+        stagefile.setmtime(stagefile.mtime() + 10)
+
+        assert cache.get(Stage(stagefile)) == {'name': 'cached'}
+
+    def test_changed(self, cache, stagefile):
+        cache.set(Stage(stagefile), {'name': 'cached'})
+        stagefile.write(content('b', ['x'], ['y']))
+        stagefile.setmtime(stagefile.mtime() + 10)
+
+        assert cache.get(Stage(stagefile)) is None
+
+    def test_runner_changed(self, cache, stagefile):
+        cache.set(Stage(stagefile), {'name': 'cached'})
+        stage = Stage(stagefile)
+        stage.runner = 'ruby'
+
+        assert cache.get(stage) is None
+
+    def test_stage_uses_cache(self, cache, stagefile):
+        assert Stage(stagefile, cache=cache).configuration['name'] == 'a'
+        assert cache.get(Stage(stagefile))['name'] == 'a'
+
+        # if the stage were run again, we'd see 'a'
+        cache.set(Stage(stagefile), {'name': 'from cache'})
+
+        assert Stage(stagefile, cache=cache).configuration == {'name': 'from cache'}
+
+
+class TestRenderCache(object):
+    def test_miss(self, tmpdir):
+        memo = RenderCache(tmpdir)
+        assert memo.get(memo.key(b'{}')) is None
+
+    def test_hit(self, tmpdir):
+        memo = RenderCache(tmpdir)
+        memo.set(memo.key(b'{}'), 'a.html', u'caf\xe9')
+
+        assert memo.get(memo.key(b'{}')) == ('a.html', u'caf\xe9')
+
+    def test_binary(self, tmpdir):
+        memo = RenderCache(tmpdir)
+        memo.set('k', 'a.png', b'\x89PNG\n\x00')
+
+        assert memo.get('k') == ('a.png', b'\x89PNG\n\x00')
+
+    def test_salt(self, tmpdir):
+        template = tmpdir.join('page.html')
+        template.write('one')
+        before = RenderCache.salt_for([str(template)])
+        template.write('two')
+
+        assert RenderCache.salt_for([str(template)]) != before
+        assert RenderCache(tmpdir, salt='a').key(b'x') != \
+            RenderCache(tmpdir, salt='b').key(b'x')
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        memo = RenderCache(tmpdir, max_bytes=1200)
+        for i in range(3):
+            memo.set(str(i), 'page', 'x' * 300)
+            os.utime(memo.path(str(i)), (i, i))
+
+        memo.get('0')  # now the most recently used
+        memo.set('3', 'page', 'x' * 300)
+
+        assert [memo.get(k) is not None for k in '0123'] == \
+            [True, False, False, True]
+        assert memo.size <= 900
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+from textwrap import dedent
+
+from perch.cli import main
+from perch.errors import OutputError
+
+SOURCE = dedent("""
+    #!/usr/bin/env python
+    from perch.bases import Collector
+
+    class Source(Collector):
+        name = 'source'
+        input_tags = []
+        output_tags = ['images']
+
+        def start(self):
+            yield {'name': 'dot'}
+
+    Source().run()
+""").strip()
+
+IMAGES = dedent("""
+    #!/usr/bin/env python
+    from perch.bases import Renderer
+
+    class Images(Renderer):
+        name = 'images'
+        input_tags = ['images']
+        output_tags = ['files']
+
+        def render(self, obj):
+            return obj['name'] + '.png', b'\\x89PNG\\r\\n\\x1a\\n\\x00\\xff'
+
+    Images().run()
+""").strip()
+
+PAGES = dedent("""
+    #!/usr/bin/env python
+    from perch.bases import Renderer
+
+    class Pages(Renderer):
+        name = 'pages'
+        input_tags = ['images']
+        output_tags = ['pages']
+        memoize = True
+        dependencies = [%r]
+
+        def render(self, obj):
+            with open(self.dependencies[0]) as f:
+                return obj['name'] + '.html', f.read() %% obj['name']
+
+    Pages().run()
+""").strip()
+
+
+BIG = dedent("""
+    #!/usr/bin/env python
+    from perch.bases import Collector
+
+    class Big(Collector):
+        name = 'big'
+        input_tags = []
+        output_tags = ['pages']
+
+        def start(self):
+            yield {'filename': 'big.html', 'content': 'x' * 100000}
+
+    Big().run()
+""").strip()
+
+COPY = dedent("""
+    #!/usr/bin/env python
+    from perch.bases import Collector
+
+    class Copy(Collector):
+        name = 'copy'
+        input_tags = ['pages']
+        output_tags = ['site']
+
+        def parse(self, obj):
+            return dict(obj)
+
+    Copy().run()
+""").strip()
+
+
+@pytest.fixture
+def stages(tmpdir, importable):
+    stages = tmpdir.join('stages')
+    stages.ensure(dir=True)
+    stages.join('source.py').write(SOURCE)
+    stages.join('images.py').write(IMAGES)
+    return stages
+
+
+class TestBuild(object):
+    def build(self, tmpdir, *args):
+        main(['build', str(tmpdir.join('stages')),
+              '--cache', str(tmpdir.join('cache'))] + list(args))
+
+    def test_binary_content(self, stages, tmpdir, capsys):
+        out = tmpdir.join('out')
+        self.build(tmpdir, '-o', str(out))
+        assert out.join('dot.png').read_binary() == b'\x89PNG\r\n\x1a\n\x00\xff'
+
+        # the second time round it comes out of the manifest
+        out.join('dot.png').remove()
+        self.build(tmpdir, '-o', str(out))
+        assert out.join('dot.png').read_binary() == b'\x89PNG\r\n\x1a\n\x00\xff'
+        assert '1 files written' in capsys.readouterr()[1]
+
+    def test_binary_content_printed(self, stages, tmpdir):
+        with pytest.raises(OutputError):
+            self.build(tmpdir, '--full')
+
+    def test_dependency_changed(self, stages, tmpdir):
+        template = tmpdir.join('page.html')
+        template.write('<p>%s</p>')
+        stages.join('pages.py').write(PAGES % str(template))
+        out = tmpdir.join('out')
+        self.build(tmpdir, '-o', str(out))
+        assert out.join('dot.html').read() == '<p>dot</p>'
+
+        template.write('<h1>%s</h1>')
+        self.build(tmpdir, '-o', str(out))
+        assert out.join('dot.html').read() == '<h1>dot</h1>'
+
+    def test_spooled_through_manifest(self, tmpdir, importable, capsys):
+        stages = tmpdir.join('stages')
+        stages.join('big.py').write(BIG, ensure=True)
+        stages.join('copy.py').write(COPY)
+        out = tmpdir.join('out')
+        self.build(tmpdir, '--spool', '-o', str(out))
+        assert out.join('big.html').read() == 'x' * 100000
+
+        # and again, out of the manifest after the spool has gone
+        capsys.readouterr()
+        self.build(tmpdir, '--spool')
+        assert '"content": "%s"' % ('x' * 100000) in capsys.readouterr()[0]
+
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+from textwrap import dedent
+
+from perch.errors import BadExit, CycleError
+from perch.executor import Executor
+from perch.router import Graph
+
+def content(name, intags, outtags, sleep=0):
+    "a stage that records its path through the graph and when it ran"
+    return dedent("""
+        #!/usr/bin/env python
+        import sys
+        import time
+        from perch.bases import Collector
+
+        class Step(Collector):
+            name = %r
+            input_tags = %r
+            output_tags = %r
+
+            def start(self):
+                yield {'path': [self.name], 'times': {}}
+
+            def process(self, in_file):
+                started = time.time()
+                time.sleep(%r)
+                for obj in Collector.process(self, in_file):
+                    obj['times'][self.name] = [started, time.time()]
+                    yield obj
+
+            def parse(self, obj):
+                if obj.get('fail') == self.name:
+                    sys.exit(1)
+
+                obj['path'].append(self.name)
+                return obj
+
+        Step().run()
+    """ % (name, intags, outtags, sleep)).strip()
+
+@pytest.fixture
+def graph(tmpdir, importable):
+    def inner(*stages):
+        for args in stages:
+            tmpdir.join('%s.py' % args[0]).write(content(*args))
+
+        return Graph(tmpdir)
+
+    return inner
+
+
+class TestExecutor(object):
+    def test_chain(self, graph):
+        out = Executor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b']), ('c', ['b'], ['c']),
+        )).run()
+
+        assert [o['path'] for o in out['c']] == [['a', 'b', 'c']]
+
+    def test_fan_in(self, graph):
+        out = Executor(graph(
+            ('a', [], ['a']), ('b', [], ['b']), ('c', ['a', 'b'], ['c']),
+        ), jobs=2).run()
+
+        assert sorted(o['path'] for o in out['c']) == [['a', 'c'], ['b', 'c']]
+
+    def test_routes_by_tag(self, graph, tmpdir):
+        tmpdir.join('src.py').write(dedent("""
+            #!/usr/bin/env python
+            from perch.bases import Collector
+
+            class Source(Collector):
+                name = 'src'
+                input_tags = []
+                output_tags = ['a', 'b']
+
+                def start(self):
+                    yield {'path': ['src'], 'times': {}, '$tag': 'a'}
+                    yield {'path': ['src'], 'times': {}, '$tag': 'b'}
+                    yield {'path': ['src'], 'times': {}}
+
+            Source().run()
+        """).strip())
+        out = Executor(graph(('x', ['a'], ['x']), ('y', ['b'], ['y']))).run()
+
+        assert len(out['x']) == len(out['y']) == 2
+        assert all('$tag' not in o for o in out['x'] + out['y'])
+
+    def test_initial(self, graph):
+        out = Executor(graph(('a', ['src'], ['a']))).run({
+            'src': [{'path': [], 'times': {}}],
+        })
+
+        assert out['a'][0]['path'] == ['a']
+
+    def test_siblings_in_parallel(self, graph):
+        out = Executor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b'], 0.5), ('c', ['a'], ['c'], 0.5),
+        ), jobs=2).run()
+
+        b, c = out['b'][0]['times']['b'], out['c'][0]['times']['c']
+        assert b[0] < c[1] and c[0] < b[1]
+
+    def test_siblings_serial(self, graph):
+        out = Executor(graph(
+            ('a', [], ['a']), ('b', ['a'], ['b'], 0.2), ('c', ['a'], ['c'], 0.2),
+        ), jobs=1).run()
+
+        b, c = out['b'][0]['times']['b'], out['c'][0]['times']['c']
+        assert b[1] <= c[0] or c[1] <= b[0]
+
+    def test_failure_stops_downstream(self, graph):
+        executor = Executor(graph(
+            ('a', ['src'], ['a']), ('b', ['a'], ['b']), ('c', ['b'], ['c']),
+        ))
+
+        with pytest.raises(BadExit):
+            executor.run({'src': [{'path': [], 'times': {}, 'fail': 'b'}]})
+
+    def test_cycle(self, graph):
+        with pytest.raises(CycleError):
+            Executor(graph(('a', ['b'], ['a']), ('b', ['a'], ['b']))).order()
+
+    def test_order(self, graph):
+        g = graph(('c', ['b'], ['c']), ('b', ['a'], ['b']), ('a', [], ['a']))
+
+        assert [s.configuration['name'] for s in Executor(g).order()] == \
+               ['a', 'b', 'c']
+
+    def test_rerun_dirty_only(self, graph):
+        g = graph(
+            ('a', [], ['a']), ('b', ['a'], ['b']), ('c', [], ['c']),
+            ('d', ['b', 'c'], ['d']),
+        )
+        first = Executor(g).run()
+        again = Executor(g).run(previous=first, dirty=[g['b']])
+
+        assert again['a'] is first['a']
+        assert again['c'] is first['c']
+        assert again['b'][0]['times']['b'] != first['b'][0]['times']['b']
+        assert sorted(o['path'] for o in again['d']) == \
+               [['a', 'b', 'd'], ['c', 'd']]
+
+    def test_downstream(self, graph):
+        g = graph(
+            ('a', [], ['a']), ('b', ['a'], ['b']), ('c', [], ['c']),
+            ('d', ['b'], ['d']),
+        )
+
+        assert Executor(g).downstream([g['a']]) == set([g['a'], g['b'], g['d']])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from io import BytesIO
+import pytest
+
+from perch.framing import framings, FrameReader, LineFraming, LengthFraming
+
+@pytest.fixture(params=['line', 'length'])
+def framing(request):
+    return framings[request.param]()
+
+
+class TestFraming(object):
+    def test_roundtrip(self, framing):
+        stream = BytesIO(framing.frame(b'a') + framing.frame(b'bc'))
+
+        assert framing.read(stream) == b'a'
+        assert framing.read(stream) == b'bc'
+        assert framing.read(stream) is None
+
+    def test_frames_until_empty(self, framing):
+        stream = BytesIO(
+            framing.frame(b'a') + framing.frame(b'') + framing.frame(b'b')
+        )
+
+        assert list(framing.frames(stream)) == [b'a']
+        assert list(framing.frames(stream)) == [b'b']
+
+    def test_frames_skip_empty(self, framing):
+        stream = BytesIO(
+            framing.frame(b'a') + framing.frame(b'') + framing.frame(b'b')
+        )
+
+        assert list(framing.frames(stream, until_empty=False)) == [b'a', b'b']
+
+
+class TestLineFraming(object):
+    def test_text_stream(self):
+        from io import StringIO
+
+        assert list(LineFraming().frames(StringIO(u'a\nb\n'))) == [u'a', u'b']
+
+
+class TestLengthFraming(object):
+    def test_binary_payload(self):
+        payload = b'\n\x00\xff\n'
+        stream = BytesIO(LengthFraming().frame(payload))
+
+        assert LengthFraming().read(stream) == payload
+
+    def test_frame(self):
+        assert LengthFraming().frame(b'ab') == b'\x00\x00\x00\x02ab'
+
+    def test_truncated(self):
+        stream = BytesIO(LengthFraming().frame(b'abc')[:-1])
+
+        assert LengthFraming().read(stream) is None
+
+
+class Trickle(object):
+    "a stream handing out at most `chunk` bytes per read, like a pipe"
+    def __init__(self, data, chunk=3):
+        self.data = data
+        self.chunk = chunk
+        self.reads = 0
+
+    def readinto1(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        self.reads += 1
+        return n
+
+
+class TestFrameReader(object):
+    def test_frames(self, framing):
+        stream = BytesIO(
+            framing.frame(b'a') + framing.frame(b'') + framing.frame(b'bc')
+        )
+        reader = FrameReader(framing, stream)
+
+        assert [p.tobytes() for p in reader.frames()] == [b'a']
+        assert [p.tobytes() for p in reader.frames()] == [b'bc']
+        assert reader.read() is None
+
+    def test_partial_reads(self, framing):
+        payloads = [b'one', b'two', b'three' * 10]
+        stream = Trickle(b''.join(framing.frame(p) for p in payloads))
+        reader = FrameReader(framing, stream, size=8)
+
+        assert [p.tobytes() for p in reader.frames(until_empty=False)] == payloads
+
+    def test_yields_before_stream_ends(self, framing):
+        stream = Trickle(framing.frame(b'a') + framing.frame(b'b' * 100), chunk=8)
+        reader = FrameReader(framing, stream)
+
+        assert reader.read().tobytes() == b'a'
+        assert stream.data  # the rest hasn't been read yet
+
+    def test_buffer_sized_by_biggest_frame(self, framing):
+        payloads = [b'x' * 100] * 50
+        reader = FrameReader(
+            framing, BytesIO(b''.join(framing.frame(p) for p in payloads)),
+            size=16,
+        )
+
+        assert [p.tobytes() for p in reader.frames()] == payloads
+        assert len(reader.buf) <= 256
+
+    def test_zero_copy(self, framing):
+        reader = FrameReader(framing, BytesIO(framing.frame(b'abc')))
+        payload = reader.read()
+
+        assert isinstance(payload, memoryview)
+        assert payload.obj is reader.buf
+
+    def test_long_line_searched_once(self):
+        class Counting(LineFraming):
+            searched = 0
+
+            def find(self, buf, start, end, scanned=None):
+                self.searched += end - max(start, scanned or start)
+                return LineFraming.find(self, buf, start, end, scanned)
+
+        framing = Counting()
+        line = b'a\n' + b'x' * 1000 + b'\nb\n'
+        reader = FrameReader(framing, Trickle(line, chunk=10), size=16)
+
+        assert [p.tobytes() for p in reader.frames()] == [b'a', b'x' * 1000, b'b']
+        assert framing.searched < 2 * len(line)
+
+    def test_blank_line(self):
+        reader = FrameReader(LineFraming(), BytesIO(b'a\n  \nb'))
+
+        assert [p.tobytes() for p in reader.frames()] == [b'a']
+        assert reader.read().tobytes() == b'b'
+
+    def test_truncated_length_frame(self):
+        framing = LengthFraming()
+        reader = FrameReader(framing, BytesIO(framing.frame(b'abc')[:-1]))
+
+        assert reader.read() is None
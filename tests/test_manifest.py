@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+from textwrap import dedent
+
+from perch.manifest import Manifest
+from perch.router import Stage
+
+def content(log, final=False, dependencies=()):
+    "a collector that logs every object it parses"
+    return dedent("""
+        #!/usr/bin/env python
+        from perch.bases import Collector
+
+        class Logger(Collector):
+            name = 'logger'
+            input_tags = ['x']
+            output_tags = ['y']
+            dependencies = %r
+            seen = []
+
+            def parse(self, obj):
+                with open(%r, 'a') as f:
+                    f.write(obj['n'] + ' ')
+
+                self.seen.append(obj['n'])
+                return {'from': obj['n']}
+
+            if %r:
+                def final(self):
+                    yield {'all': sorted(self.seen)}
+
+        Logger().run()
+    """ % (list(dependencies), str(log), final)).strip()
+
+@pytest.fixture
+def setup(tmpdir, importable):
+    def inner(final=False, dependencies=()):
+        log = tmpdir.join('log')
+        f = tmpdir.join('stage.py')
+        f.write(content(log, final, dependencies))
+
+        def processed():
+            if not log.check():
+                return []
+
+            seen = log.read().split()
+            log.remove()
+            return seen
+
+        return Stage(f), Manifest(tmpdir.join('.perch-cache')), processed
+
+    return inner
+
+def objs(*names):
+    return [{'n': n} for n in names]
+
+
+class TestManifest(object):
+    def test_first_run(self, setup):
+        stage, manifest, processed = setup()
+
+        assert manifest.process(stage, objs('a', 'b')) == \
+               [{'from': 'a'}, {'from': 'b'}]
+        assert processed() == ['a', 'b']
+
+    def test_unchanged(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        assert manifest.process(stage, objs('a', 'b')) == \
+               [{'from': 'a'}, {'from': 'b'}]
+        assert processed() == []
+
+    def test_only_changed(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        assert manifest.process(stage, objs('a', 'c', 'b')) == \
+               [{'from': 'a'}, {'from': 'c'}, {'from': 'b'}]
+        assert processed() == ['c']
+
+    def test_removed(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        assert manifest.process(stage, objs('b')) == [{'from': 'b'}]
+        assert processed() == []
+
+    def test_aggregates_rerun_everything(self, setup):
+        stage, manifest, processed = setup(final=True)
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        assert manifest.process(stage, objs('a', 'c')) == \
+               [{'from': 'a'}, {'from': 'c'}, {'all': ['a', 'c']}]
+        assert processed() == ['a', 'c']
+
+    def test_aggregates_unchanged(self, setup):
+        stage, manifest, processed = setup(final=True)
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        assert manifest.process(stage, objs('a', 'b'))[-1] == {'all': ['a', 'b']}
+        assert processed() == []
+
+    def test_stage_changed(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a'))
+        processed()
+
+        stage.pathfile.write(stage.pathfile.read() + '\n')
+        manifest.process(stage, objs('a'))
+        assert processed() == ['a']
+
+    def test_dependency_changed(self, setup, tmpdir):
+        template = tmpdir.join('page.html')
+        template.write('one')
+        stage, manifest, processed = setup(dependencies=[str(template)])
+        manifest.process(stage, objs('a'))
+        processed()
+
+        template.write('two')
+        manifest.process(stage, objs('a'))
+        assert processed() == ['a']
+
+    def test_outputs_kept_apart(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a', 'b'))
+        manifest.process(stage, objs('b'))
+
+        # the index only has hashes; removed inputs' outputs are gone
+        entry = manifest.get(stage)
+        assert entry['outputs'] == [manifest.hash({'n': 'b'})]
+        assert manifest.load(entry, entry['outputs'][0]) == [{'from': 'b'}]
+        assert sum(len(files) for _, _, files in os.walk(manifest.objects)) == 2
+
+    def test_missing_output(self, setup):
+        stage, manifest, processed = setup()
+        manifest.process(stage, objs('a', 'b'))
+        processed()
+
+        entry = manifest.get(stage)
+        manifest.forget(entry, [manifest.hash({'n': 'a'})])
+        assert manifest.process(stage, objs('a', 'b')) == \
+               [{'from': 'a'}, {'from': 'b'}]
+        assert processed() == ['a']
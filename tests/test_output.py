@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from perch.errors import OutputError
+from perch.output import OutputWriter
+
+
+@pytest.fixture
+def writer(tmpdir):
+    return OutputWriter(tmpdir.join('site'), jobs=4)
+
+
+class TestOutputWriter(object):
+    def test_writes(self, writer, tmpdir):
+        counts = writer.write([
+            {'filename': 'index.html', 'content': u'caf\xe9'},
+            {'filename': 'posts/a/index.html', 'content': 'a'},
+            {'filename': 'img/a.png', 'content': b'\x89PNG'},
+        ])
+
+        site = tmpdir.join('site')
+        assert counts == {'written': 3, 'unchanged': 0}
+        assert site.join('index.html').read_binary() == u'caf\xe9'.encode('utf-8')
+        assert site.join('posts', 'a', 'index.html').read() == 'a'
+        assert site.join('img', 'a.png').read_binary() == b'\x89PNG'
+
+    def test_no_temporary_files_left(self, writer, tmpdir):
+        writer.write([{'filename': 'a.html', 'content': 'a'}])
+
+        assert tmpdir.join('site').listdir() == [tmpdir.join('site', 'a.html')]
+
+    def test_permissions(self, writer, tmpdir):
+        writer.write([{'filename': 'a.html', 'content': 'a'}])
+
+        mode = os.stat(str(tmpdir.join('site', 'a.html'))).st_mode & 0o777
+        assert mode == writer.mode
+
+    def test_skips_unchanged(self, writer, tmpdir):
+        writer.write([{'filename': 'a.html', 'content': 'a'}])
+        page = tmpdir.join('site', 'a.html')
+        page.setmtime(1000)
+
+        counts = writer.write([
+            {'filename': 'a.html', 'content': 'a'},
+            {'filename': 'b.html', 'content': 'b'},
+        ])
+
+        assert counts == {'written': 1, 'unchanged': 1}
+        assert page.mtime() == 1000
+
+    def test_rewrites_changed(self, writer, tmpdir):
+        writer.write([{'filename': 'a.html', 'content': 'a'}])
+        counts = writer.write([{'filename': 'a.html', 'content': 'b'}])
+
+        assert counts == {'written': 1, 'unchanged': 0}
+        assert tmpdir.join('site', 'a.html').read() == 'b'
+
+    def test_outside_directory(self, writer):
+        with pytest.raises(OutputError):
+            writer.write([{'filename': '../escape.html', 'content': 'x'}])
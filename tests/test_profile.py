@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import pytest
+
+from perch.profile import Profile, Record
+from perch.router import Stage
+
+from .test_router import ECHO, content, handler_content
+
+@pytest.fixture
+def profile():
+    return Profile()
+
+
+class TestRecord(object):
+    def test_count_in(self):
+        record = Record('a', 'process')
+
+        assert list(record.count_in([b'ab\n', b'c\n'])) == [b'ab\n', b'c\n']
+        assert (record.objects_in, record.bytes_in) == (2, 5)
+
+    def test_output(self):
+        record = Record('a', 'process')
+        record.output(b'abc')
+        record.output(b'de')
+        record.finish()
+
+        run = record.as_dict()
+        assert (run['objects_out'], run['bytes_out']) == (2, 5)
+        assert 0 <= run['first_output_s'] <= run['wall_s']
+
+
+class TestProfile(object):
+    def test_process(self, tmpdir, profile):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+        Stage(f, profile=profile).process([{'a': 1}, {'b': 2}])
+
+        run, = [r.as_dict() for r in profile.records]
+        assert run['stage'] == 'test.py'
+        assert run['command'] == 'process'
+        assert (run['objects_in'], run['objects_out']) == (2, 2)
+        assert run['bytes_in'] > 0 and run['bytes_out'] > 0
+        assert run['spawn_s'] <= run['first_output_s'] <= run['wall_s']
+        assert run['cpu_user_s'] is not None
+        assert run['max_rss_kb'] > 0
+
+    def test_config_named(self, tmpdir, profile):
+        f = tmpdir.join('test.py')
+        f.write(content('named', [], []))
+        Stage(f, profile=profile).configuration
+
+        assert profile.records[0].stage == 'named'
+
+    def test_persistent(self, tmpdir, importable, profile):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', [], []))
+        stage = Stage(f, persistent=True, profile=profile)
+        stage.process([{'a': 1}])
+        stage.process([{'a': 2}])
+        stage.close()
+
+        assert [r.command for r in profile.records] == \
+               ['config', 'process', 'process', 'serve']
+
+        # the worker's life isn't counted on top of the requests in it
+        summary = profile.summary()['a']
+        assert (summary['runs'], summary['workers']) == (3, 1)
+        assert summary['objects_out'] == 2
+        assert summary['wall_s'] == pytest.approx(sum(
+            r.as_dict()['wall_s'] for r in profile.records
+            if r.command != 'serve'
+        ))
+
+    def test_stderr_surfaced(self, tmpdir, profile):
+        f = tmpdir.join('test.sh')
+        f.write('echo oops >&2')
+        list(Stage(f, profile=profile).stream('process'))
+
+        assert profile.records[0].as_dict()['stderr'] == 'oops\n'
+
+    def test_chrome_trace(self, tmpdir, profile):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+        Stage(f, profile=profile).process([{'a': 1}])
+
+        trace = json.loads(json.dumps(profile.chrome_trace()))
+        complete = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        assert [e['name'] for e in complete] == ['test.py process']
+        assert complete[0]['dur'] > 0
+
+    def test_table(self, tmpdir, profile):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+        Stage(f, profile=profile).process([{'a': 1}])
+
+        header, row = profile.table().splitlines()
+        assert header.split()[0] == 'stage'
+        assert row.split()[:2] == ['test.py', '1']
@@ -2,10 +2,15 @@
 # -*- coding: utf-8 -*-
 import json
 import pytest
+import threading
+import time
 from textwrap import dedent
 
-from perch.router import Graph, Stage
-from perch.errors import BadRunner, BadExit
+from perch.router import Graph, Router, Stage
+from perch.errors import (
+    BadRunner, BadExit, ConfigurationError, DuplicateStage, RoutingError,
+)
+from perch.serializers import serializers
 
 def content(name, intags, outtags):
     return dedent("""
@@ -25,6 +30,37 @@ def content(name, intags, outtags):
         'output_tags': outtags,
     })).strip()
 
+def handler_content(name, intags, outtags):
+    "a stage built on perch.bases, so it can serve persistent requests"
+    return dedent("""
+        #!/usr/bin/env python
+        import os
+        import sys
+        from perch.bases import Collector
+
+        class Echo(Collector):
+            name = %r
+            input_tags = %r
+            output_tags = %r
+
+            def parse(self, obj):
+                if 'exit' in obj:
+                    sys.exit(obj['exit'])
+
+                obj['pid'] = os.getpid()
+                return obj
+
+        Echo().run()
+    """ % (name, intags, outtags)).strip()
+
+ECHO = dedent("""
+    import sys
+
+    for line in iter(sys.stdin.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+""")
+
 def makestage(tname, *content_args):
     "make a stage object given a temp name and content args"
     tname.ensure()
@@ -46,6 +82,76 @@ class TestGraph(object):
 
         assert graph.stages == files
 
+    def test_stages_skip_ignored(self, tmpdir):
+        stage = makestage(tmpdir.join('a.py'), 'a', [], [])
+        tmpdir.join('.a.py.swp').write('junk')
+        tmpdir.join('.perch-cache', 'config', 'x.json').ensure()
+
+        assert Graph(tmpdir).stages == [stage]
+
+    def test_graph_is_lazy(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], [])
+        g = Graph(tmpdir)
+
+        assert not any(hasattr(s, '_configuration') for s in g.stages)
+        g.graph
+        assert all(hasattr(s, '_configuration') for s in g.stages)
+
+    def test_probes_concurrently(self, tmpdir):
+        for name in 'abcd':
+            tmpdir.join('%s.py' % name).write(
+                content(name, [], []).replace('import sys', 'import sys, time') +
+                '\ntime.sleep(0.5)\n'
+            )
+
+        started = time.time()
+        Graph(tmpdir).graph
+
+        assert time.time() - started < 1.5
+
+    def test_probe_errors_per_stage(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], [])
+        tmpdir.join('b.py').write('import sys; sys.exit(2)')
+        tmpdir.join('c.py').write('import sys; sys.exit(3)')
+
+        with pytest.raises(ConfigurationError) as exc:
+            Graph(tmpdir).graph
+
+        assert sorted(s.pathfile.basename for s, _ in exc.value.errors) == \
+            ['b.py', 'c.py']
+        assert all(isinstance(e, BadExit) for _, e in exc.value.errors)
+
+    def test_reload_changed(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], ['a'])
+        makestage(tmpdir.join('b.py'), 'b', ['a'], ['b'])
+        g = Graph(tmpdir)
+        old = g['a']
+
+        tmpdir.join('a.py').write(content('renamed', [], ['a']))
+        assert g.reload(tmpdir.join('a.py')) == set([g['renamed'], g['b']])
+        assert g['renamed'] is not old
+        assert [s.configuration['name'] for s in g.stages] == ['renamed', 'b']
+
+    def test_reload_added(self, tmpdir):
+        makestage(tmpdir.join('b.py'), 'b', [], ['b'])
+        g = Graph(tmpdir)
+        g.graph
+
+        makestage(tmpdir.join('a.py'), 'a', [], ['a'])
+        assert g.reload(str(tmpdir.join('a.py'))) == set([g['a']])
+        assert len(g.stages) == 2
+
+    def test_reload_removed(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], ['a'])
+        makestage(tmpdir.join('b.py'), 'b', ['a'], ['b'])
+        g = Graph(tmpdir)
+        g.graph
+
+        tmpdir.join('a.py').remove()
+        assert g.reload(tmpdir.join('a.py')) == set([g['b']])
+        with pytest.raises(KeyError):
+            g['a']
+
     def test_get_by_name(self, tmpdir):
         stage = makestage(tmpdir.join('a.py'), 'a', [], [])
         g = Graph(None, [stage])
@@ -57,6 +163,32 @@ class TestGraph(object):
             Graph(None, [])['a']
 
 
+    def test_get_by_name_reads_configuration_once(self, tmpdir):
+        stage = makestage(tmpdir.join('a.py'), 'a', [], [])
+        g = Graph(None, [stage])
+        g['a']
+
+        stage._configuration = {'name': 'changed', 'input_tags': [], 'output_tags': []}
+        assert g['a'] == stage
+
+    def test_duplicate_names(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], [])
+        makestage(tmpdir.join('b.py'), 'a', [], [])
+
+        with pytest.raises(DuplicateStage):
+            Graph(tmpdir)['a']
+
+    def test_consumers_and_producers(self, tmpdir):
+        a = makestage(tmpdir.join('a.py'), 'a', ['f'], ['a'])
+        b = makestage(tmpdir.join('b.py'), 'b', ['a'], ['b'])
+        c = makestage(tmpdir.join('c.py'), 'c', ['a'], ['b'])
+        g = Graph(tmpdir)
+
+        assert g.consumers('a') == set([b, c])
+        assert g.producers('b') == set([b, c])
+        assert g.producers('f') == set()
+        assert g.consumers('nothing') == set()
+
     def test_build_graph_single_chain(self, tmpdir):
         a = makestage(tmpdir.join('a.py'), 'a', ['f'], ['a'])
         b = makestage(tmpdir.join('b.py'), 'b', ['a'], ['b'])
@@ -79,6 +211,17 @@ class TestGraph(object):
             'c': set(),
         }
 
+    def test_pipe(self, tmpdir, importable):
+        for name in 'ab':
+            tmpdir.join('%s.py' % name).write(handler_content(name, [], []))
+
+        lines = [{'n': n} for n in range(100)]
+
+        with Graph(tmpdir) as g:
+            out = list(g.pipe(['a', 'b'], iter(lines)))
+
+        assert [o['n'] for o in out] == list(range(100))
+
     def test_build_graph_with_empty(self, tmpdir):
         makestage(tmpdir.join('a.py'), 'a', [], [])
         assert Graph(tmpdir).graph == {}
@@ -114,6 +257,12 @@ class TestStage(object):
 
         assert stage._runner() == output
 
+    def test_runner_reads_first_line_only(self, tmpdir):
+        f = tmpdir.join('test')
+        f.write_binary(b'#!/usr/bin/env ruby\n' + b'\xff' * 100000)
+
+        assert Stage(f)._runner() == '/usr/bin/env ruby'
+
     def test_run_config(self, tmpdir):
         makestage(tmpdir.join('test'), 'a', ['x'], ['y']).run('config')
 
@@ -162,6 +311,205 @@ class TestStage(object):
 
         assert stage.process(lines) == lines
 
+    def test_process_persistent(self, tmpdir, importable):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', ['x'], ['y']))
+
+        stage = Stage(f, persistent=True)
+        try:
+            first = stage.process([{'a': 1}, {'b': 2}])
+            second = stage.process([{'c': 3}])
+        finally:
+            stage.close()
+
+        assert [dict((k, v) for k, v in o.items() if k != 'pid') for o in first + second] == \
+               [{'a': 1}, {'b': 2}, {'c': 3}]
+        assert len(set(o['pid'] for o in first + second)) == 1
+
+    def test_process_persistent_fallback(self, tmpdir):
+        "stages that don't advertise serve still run one-shot"
+        f = tmpdir.join('test.py')
+        f.write(content('a', ['x'], ['y']))
+
+        stage = Stage(f, persistent=True)
+
+        assert stage.process([{'a': 'b'}]) == [{'a': 'b'}]
+        assert stage._worker is None
+
+    def test_persistent_worker_dies(self, tmpdir, importable):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', ['x'], ['y']))
+
+        stage = Stage(f, persistent=True)
+
+        with pytest.raises(BadExit):
+            stage.process([{'exit': 3}])
+
+        # the next request gets a fresh worker
+        assert len(stage.process([{'a': 1}])) == 1
+        stage.close()
+
+    def test_stream_before_input_ends(self, tmpdir):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+        seen = threading.Event()
+
+        def objs():
+            yield {'n': 1}
+            # only continue once the first object made it all the way through
+            seen.wait(5)
+            yield {'n': 2}
+
+        out = []
+        for obj in Stage(f).stream('process', objs()):
+            out.append(obj)
+            seen.set()
+
+        assert out == [{'n': 1}, {'n': 2}]
+
+    def test_stream_flushes_while_waiting(self, tmpdir, importable):
+        f = tmpdir.join('echo.py')
+        f.write(handler_content('echo', ['in'], ['out']))
+        stage = Stage(f)
+        seen = threading.Event()
+        waited = []
+
+        def objs():
+            yield {'n': 1}
+            # the stage is left waiting for input with its output unflushed
+            waited.append(seen.wait(5))
+            yield {'n': 2}
+
+        for obj in stage.stream('process', objs()):
+            seen.set()
+
+        assert waited == [True]
+
+    def test_stream_upstream_error(self, tmpdir):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+
+        def objs():
+            yield {'n': 1}
+            raise BadExit('upstream')
+
+        with pytest.raises(BadExit):
+            list(Stage(f).stream('process', objs()))
+
+    def test_stream_nonzero_exit_code(self, tmpdir):
+        f = tmpdir.join('test.sh')
+        f.write('exit 1')
+
+        with pytest.raises(BadExit):
+            list(Stage(f).stream('process', [{'n': 1}]))
+
+    def test_stream_stops_early(self, tmpdir):
+        f = tmpdir.join('test.py')
+        f.write(ECHO)
+
+        def objs():
+            n = 0
+            while True:
+                n += 1
+                yield {'n': n}
+
+        out = Stage(f).stream('process', objs())
+        assert next(out) == {'n': 1}
+        out.close()
+
+    @pytest.mark.parametrize("size,nbytes,expected", [
+        (None, None, [5]),
+        (2, None, [2, 2, 1]),
+        (None, 20, [2, 2, 1]),
+        (1, 1000, [1, 1, 1, 1, 1]),
+        (None, 1, [1, 1, 1, 1, 1]),
+    ])
+    def test_batches(self, tmpdir, size, nbytes, expected):
+        f = tmpdir.join('test.py')
+        f.ensure()
+        stage = Stage(f, batch_size=size, batch_bytes=nbytes)
+
+        # each of these is 9 bytes serialized, with the newline
+        batches = list(stage.batches({'n': n} for n in range(5)))
+
+        assert [len(b) for b in batches] == expected
+
+    def test_batches_empty(self, tmpdir):
+        f = tmpdir.join('test.py')
+        f.ensure()
+
+        assert list(Stage(f, batch_size=2).batches([])) == [[]]
+
+    def test_process_batched(self, tmpdir, importable):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', ['x'], ['y']))
+
+        out = Stage(f, batch_size=3).process({'n': n} for n in range(10))
+
+        assert [o['n'] for o in out] == list(range(10))
+        assert len(set(o['pid'] for o in out)) == 4
+
+    def test_map_batched(self, tmpdir, importable):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', ['x'], ['y']))
+
+        groups = Stage(f, batch_size=3).map({'n': n} for n in range(10))
+
+        assert [[o['n'] for o in g] for g in groups] == \
+            [[n] for n in range(10)] + [[]]
+        assert len(set(g[0]['pid'] for g in groups[:-1])) == 4
+
+    def test_negotiate_default(self, tmpdir):
+        "stages that don't say what they speak get the default"
+        stage = makestage(tmpdir.join('test.py'), 'a', [], [])
+
+        assert stage.negotiate() == 'json'
+
+    def test_negotiate_preference(self, tmpdir, importable):
+        f = tmpdir.join('test.py')
+        f.write(handler_content('a', [], []))
+
+        assert Stage(f, formats=['fastjson', 'json']).negotiate() == 'fastjson'
+        assert Stage(f, formats=['nonexistent', 'json']).negotiate() == 'json'
+
+    def test_negotiate_unsupported_by_stage(self, tmpdir):
+        f = tmpdir.join('test.py')
+        f.write(dedent("""
+            import sys
+
+            if sys.argv[-1] == 'config':
+                print('{"name": "a", "input_tags": [], "output_tags": [], '
+                      '"serializers": ["json"]}')
+        """))
+
+        assert Stage(f, formats=['fastjson', 'json']).negotiate() == 'json'
+
+    @pytest.mark.parametrize("persistent", [False, True])
+    @pytest.mark.parametrize("name", [
+        name for name in ['fastjson', 'msgpack'] if name in serializers
+    ])
+    def test_negotiated_serializer_exported(self, tmpdir, importable, persistent, name):
+        f = tmpdir.join('test.py')
+        f.write(dedent("""
+            from perch.bases import Collector
+
+            class Which(Collector):
+                name = 'which'
+                input_tags = []
+                output_tags = []
+
+                def parse(self, obj):
+                    return {'serializer': self.serializer.name}
+
+            Which().run()
+        """))
+
+        stage = Stage(f, persistent=persistent, formats=[name])
+        try:
+            assert stage.process([{}]) == [{'serializer': name}]
+        finally:
+            stage.close()
+
     def test_equality(self, tmpdir):
         f = tmpdir.join('test.py')
         f.ensure()
@@ -182,3 +530,55 @@ class TestStage(object):
         f.ensure()
 
         assert repr(Stage(f)) == 'Stage(%r)' % f.basename
+
+
+class TestRouter(object):
+    @pytest.fixture
+    def graph(self, tmpdir):
+        makestage(tmpdir.join('a.py'), 'a', [], ['html', 'css'])
+        makestage(tmpdir.join('b.py'), 'b', ['html'], ['out'])
+        makestage(tmpdir.join('c.py'), 'c', ['css'], ['out'])
+        makestage(tmpdir.join('d.py'), 'd', ['html', 'css'], ['out'])
+        return Graph(tmpdir)
+
+    def test_route_untagged(self, graph):
+        router = Router(graph)
+        assert router.route(graph['a'], {}) == set([
+            graph['b'], graph['c'], graph['d'],
+        ])
+
+    def test_route_tagged(self, graph):
+        router = Router(graph)
+        assert router.route(graph['a'], {'$tag': 'css'}) == set([
+            graph['c'], graph['d'],
+        ])
+
+    def test_route_tag_list(self, graph):
+        router = Router(graph)
+        assert router.route(graph['a'], {'$tag': ['html', 'css']}) == set([
+            graph['b'], graph['c'], graph['d'],
+        ])
+
+    def test_route_undeclared(self, graph):
+        with pytest.raises(RoutingError):
+            Router(graph).route(graph['a'], {'$tag': 'js'})
+
+    def test_plain_tag_field_is_data(self, graph):
+        post = {'tag': 'python', 'n': 1}
+        queues = Router(graph).dispatch(graph['a'], [post])
+
+        assert queues[graph['b']] == [post]
+
+    def test_route_no_consumers(self, graph):
+        assert Router(graph).route(graph['b'], {}) == set()
+
+    def test_dispatch(self, graph):
+        html, css = {'$tag': 'html', 'n': 1}, {'$tag': 'css', 'n': 2}
+        queues = Router(graph).dispatch(graph['a'], [html, css])
+
+        assert queues == {
+            graph['b']: [{'n': 1}],
+            graph['c']: [{'n': 2}],
+            graph['d']: [{'n': 1}, {'n': 2}],
+        }
+        assert html['$tag'] == 'html'  # the stage's own output is untouched
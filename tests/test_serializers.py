@@ -3,7 +3,7 @@
 from datetime import datetime
 import pytest
 
-from perch.serializers import JSONSerializer
+from perch.serializers import JSONSerializer, FastJSONSerializer, serializers
 
 @pytest.fixture
 def json():
@@ -18,6 +18,9 @@ class TestJSONSerializer(object):
     def test_loads(self, json):
         assert json.load('[]') == []
 
+    def test_loads_memoryview(self, json):
+        assert json.load(memoryview(b'{"a": 1}')) == {'a': 1}
+
     def test_dumps(self, json):
         assert json.dump([]) == '[]'
 
@@ -26,3 +29,47 @@ class TestJSONSerializer(object):
 
     def test_loads_dates(self, json, now):
         assert json.load('{"date": "%s"}' % now.isoformat()) == {'date': now.isoformat()}
+
+
+@pytest.fixture
+def fastjson():
+    return FastJSONSerializer()
+
+
+class TestFastJSONSerializer(object):
+    def test_loads(self, fastjson):
+        assert fastjson.load(b'{"a": [1, 2]}') == {'a': [1, 2]}
+
+    def test_loads_memoryview(self, fastjson):
+        assert fastjson.load(memoryview(b'{"a": 1}')) == {'a': 1}
+
+    def test_roundtrip(self, fastjson, now):
+        assert fastjson.load(fastjson.dump({'date': now})) == {'date': now.isoformat()}
+
+    def test_dump_bytes(self, fastjson):
+        assert fastjson.dump_bytes({'a': 1}) == fastjson.dump({'a': 1}).encode('utf-8')
+
+    def test_compatible_with_json(self, fastjson, json):
+        obj = {'a': [1, 2.5, None, True], 'b': u'\u2603'}
+
+        assert json.load(fastjson.dump_bytes(obj)) == obj
+        assert fastjson.load(json.dump(obj)) == obj
+
+
+@pytest.mark.skipif('msgpack' not in serializers, reason='msgpack is not installed')
+class TestMsgpackSerializer(object):
+    @pytest.fixture
+    def msgpack(self):
+        return serializers['msgpack']()
+
+    def test_roundtrip(self, msgpack):
+        obj = {'a': [1, 2], 'image': b'\x89PNG\n\x00'}
+
+        assert msgpack.load(msgpack.dump(obj)) == obj
+        assert msgpack.load(memoryview(msgpack.dump(obj))) == obj
+
+    def test_dumps_dates(self, msgpack, now):
+        assert msgpack.load(msgpack.dump({'date': now})) == {'date': now.isoformat()}
+
+    def test_length_framed(self, msgpack):
+        assert msgpack.framing == 'length'
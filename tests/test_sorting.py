@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from perch.sorting import ExternalSort
+
+
+@pytest.fixture
+def posts():
+    return [{'date': '2014-01-%02d' % (i % 28 + 1), 'n': i} for i in range(100)]
+
+
+class TestExternalSort(object):
+    def test_in_memory(self, posts, tmpdir):
+        with ExternalSort(lambda p: p['date'], directory=str(tmpdir)) as s:
+            s.extend(posts)
+
+            assert list(s) == sorted(posts, key=lambda p: p['date'])
+            assert s.runs == []
+            assert tmpdir.listdir() == []
+
+    def test_spills(self, posts, tmpdir):
+        with ExternalSort(lambda p: p['date'], limit=7, directory=str(tmpdir)) as s:
+            s.extend(posts)
+
+            assert len(s.runs) == 14
+            assert len(s) == 100
+            assert list(s) == sorted(posts, key=lambda p: p['date'])
+
+        assert tmpdir.listdir() == []
+
+    def test_stable(self, posts):
+        s = ExternalSort(lambda p: p['date'], limit=10)
+        s.extend(posts)
+
+        for _, group in s.groups():
+            assert [p['n'] for p in group] == sorted(p['n'] for p in group)
+
+        s.close()
+
+    def test_groups(self, posts):
+        s = ExternalSort(lambda p: p['date'][:7], limit=3)
+        s.extend(posts)
+
+        assert [(k, len(g)) for k, g in s.groups()] == [('2014-01', 100)]
+        s.close()
+
+    def test_load(self):
+        s = ExternalSort(limit=1, load=lambda obj: obj * 2)
+        s.extend([3, 1, 2])
+
+        assert list(s) == [2, 4, 6]
+        s.close()
+
+    def test_close_removes_runs(self):
+        s = ExternalSort(limit=1)
+        s.extend([1, 2])
+        directory = s.directory
+        s.close()
+
+        assert not os.path.exists(directory)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+from textwrap import dedent
+
+from perch.router import Stage
+from perch.serializers import JSONSerializer
+from perch.spool import Spool, SpooledObject, is_handle, plain
+
+@pytest.fixture
+def spool(request):
+    s = Spool(threshold=10)
+    request.addfinalizer(s.close)
+    return s
+
+BIG = u'x' * 100
+
+
+class TestSpool(object):
+    def test_put_get_text(self, spool):
+        assert spool.get(spool.put(u'abc ☃')) == u'abc ☃'
+
+    def test_put_get_bytes(self, spool):
+        assert spool.get(spool.put(b'\x00\xff')) == b'\x00\xff'
+
+    def test_get_after_growth(self, spool):
+        first = spool.put(b'a' * 20)
+        assert spool.get(first) == b'a' * 20
+
+        second = spool.put(b'b' * 20)
+        assert spool.get(second) == b'b' * 20
+
+    def test_spill_small(self, spool):
+        obj = {'content': 'small'}
+
+        assert spool.spill(obj) is obj
+
+    def test_spill_big(self, spool):
+        spilled = spool.spill({'filename': 'a', 'content': BIG})
+
+        assert is_handle(dict.__getitem__(spilled, 'content'))
+        assert spilled['content'] == BIG
+        assert spilled.get('content') == BIG
+        assert spilled['filename'] == 'a'
+
+    def test_serializes_handle(self, spool):
+        spilled = spool.spill({'content': BIG})
+        dumped = JSONSerializer().dump(spilled)
+
+        assert BIG not in dumped
+        assert spool.lazy(JSONSerializer().load(dumped))['content'] == BIG
+
+    def test_lazy_plain(self, spool):
+        obj = {'content': 'small'}
+
+        assert spool.lazy(obj) is obj
+
+    def test_plain(self, spool):
+        spilled = spool.spill({'content': BIG})
+
+        assert not isinstance(plain(spilled), SpooledObject)
+        assert plain(spilled) == {'content': BIG}
+
+    def test_groups(self, spool):
+        "map output is a list of objects; each one is spilled and loaded"
+        dumped = JSONSerializer().dump(spool.spill([{'content': BIG}, {'n': 1}]))
+
+        assert BIG not in dumped
+        group = spool.lazy(JSONSerializer().load(dumped))
+        assert [plain(obj) for obj in group] == [{'content': BIG}, {'n': 1}]
+
+    def test_rotate(self, spool):
+        first = spool.put(b'a')
+        spool.rotate()
+        second = spool.put(b'b')
+
+        assert first['$spool'] != second['$spool']
+        assert second['offset'] == 0
+        assert spool.get(first) == b'a'
+
+    def test_collect(self, spool):
+        dropped = spool.spill({'content': BIG})
+        spool.rotate()
+        kept = spool.spill({'content': BIG.upper()})
+        spool.collect([kept, {'n': 1}])
+
+        assert not os.path.exists(dict.__getitem__(dropped, 'content')['$spool'])
+        assert kept['content'] == BIG.upper()
+
+        after = spool.spill({'content': BIG})  # goes to a new file
+        assert after['content'] == BIG
+        spool.collect([])
+        assert os.listdir(spool.directory) == []
+
+    def test_close_removes_directory(self):
+        spool = Spool()
+        spool.put(b'abc')
+        spool.close()
+
+        assert not os.path.exists(spool.directory)
+
+
+def test_stage_round_trip(tmpdir, importable, spool):
+    "big content goes to the stage and back through the spool"
+    f = tmpdir.join('test.py')
+    f.write(dedent("""
+        from perch.bases import Renderer
+
+        class Upper(Renderer):
+            name = 'upper'
+            input_tags = []
+            output_tags = []
+
+            def render(self, obj):
+                assert isinstance(dict.__getitem__(obj, 'content'), dict)
+                return obj['filename'], obj['content'].upper()
+
+        Upper().run()
+    """))
+
+    out = Stage(f, spool=spool).process([{'filename': 'a', 'content': BIG}])
+
+    assert is_handle(dict.__getitem__(out[0], 'content'))
+    assert out[0]['content'] == BIG.upper()
+
+
+def test_worker_requests_collected_apart(tmpdir, importable, spool):
+    "a persistent worker starts a new spool file for every request"
+    f = tmpdir.join('test.py')
+    f.write(dedent("""
+        from perch.bases import Renderer
+
+        class Upper(Renderer):
+            name = 'upper'
+            input_tags = []
+            output_tags = []
+
+            def render(self, obj):
+                return obj['filename'], obj['content'].upper()
+
+        Upper().run()
+    """))
+
+    stage = Stage(f, persistent=True, spool=spool)
+    try:
+        first = stage.request('process', [{'filename': 'a', 'content': BIG}])
+        spool.collect([])
+        second = stage.request('process', [{'filename': 'b', 'content': BIG}])
+        spool.collect(second)
+
+        assert len(os.listdir(spool.directory)) == 1
+        assert second[0]['content'] == BIG.upper()
+    finally:
+        stage.close()
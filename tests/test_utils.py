@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import os
 import pytest
-from perch.utils import ClassRegistry, files_in_dir
+from perch.utils import ClassRegistry, files_in_dir, prefetch
 
 @pytest.fixture
 def registry():
@@ -43,3 +43,26 @@ def test_files_in_dir(dir_with_files):
 
     assert set(files_in_dir(dir_with_files)) == \
            set([dir_with_files.join(fname) for fname in fnames])
+
+def test_files_in_dir_ignore(tmpdir):
+    for f in ['a.py', 'a.pyc', '.a.py.swp', 'a.py~', '.git/config', 'x/b.py',
+              'x/__pycache__/b.pyc']:
+        tmpdir.join(f).ensure(file=True)
+
+    patterns = ['.*', '*~', '*.pyc', '__pycache__']
+
+    assert set(files_in_dir(tmpdir, patterns)) == \
+           set([tmpdir.join('a.py'), tmpdir.join('x/b.py')])
+
+def test_prefetch():
+    assert list(prefetch(iter(range(10)))) == list(range(10))
+
+def test_prefetch_error():
+    def broken():
+        yield 1
+        raise ValueError('broken')
+
+    items = prefetch(broken())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
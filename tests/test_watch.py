@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+from perch import watch
+
+
+@pytest.fixture(params=['polling', 'inotify'])
+def make_watcher(request):
+    if request.param == 'inotify' and watch.libc is None:
+        pytest.skip('needs inotify')
+
+    def inner(*paths):
+        if request.param == 'polling':
+            watcher = watch.PollingWatcher(paths, interval=0.01)
+        else:
+            watcher = watch.InotifyWatcher(paths)
+
+        request.addfinalizer(watcher.close)
+        return watcher
+
+    return inner
+
+
+class TestWatchers(object):
+    def test_nothing_changed(self, make_watcher, tmpdir):
+        tmpdir.join('a.md').write('a')
+        assert make_watcher(tmpdir).changes(timeout=0.05) == set()
+
+    def test_changed(self, make_watcher, tmpdir):
+        a = tmpdir.join('a.md')
+        a.write('a')
+        watcher = make_watcher(tmpdir)
+        a.write('changed')
+
+        assert watcher.changes(timeout=1) == set([str(a)])
+
+    def test_added_and_removed(self, make_watcher, tmpdir):
+        a = tmpdir.join('a.md')
+        a.write('a')
+        watcher = make_watcher(tmpdir)
+        a.remove()
+        b = tmpdir.join('sub', 'b.md')
+        b.write('b', ensure=True)
+
+        changed = watcher.changes(timeout=1)
+        changed.update(watcher.changes(timeout=0.1))
+        assert changed == set([str(a), str(b)])
+
+    def test_ignored(self, make_watcher, tmpdir):
+        watcher = make_watcher(tmpdir)
+        tmpdir.join('.a.md.swp').write('x')
+        tmpdir.join('.perch-cache', 'config', 'x.json').write('x', ensure=True)
+
+        assert watcher.changes(timeout=0.1) == set()
+
+
+def test_watcher_picks_inotify(tmpdir):
+    w = watch.watcher([tmpdir])
+    try:
+        expected = watch.PollingWatcher if watch.libc is None else watch.InotifyWatcher
+        assert isinstance(w, expected)
+    finally:
+        w.close()
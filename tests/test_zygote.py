@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import sys
+from textwrap import dedent
+
+from perch import zygote
+from perch.router import Stage
+
+from .test_router import handler_content
+
+pytestmark = pytest.mark.skipif(not zygote.available, reason='needs fork')
+
+
+@pytest.fixture
+def zygotes(request, importable):
+    pool = zygote.Zygotes()
+    request.addfinalizer(pool.close)
+    return pool
+
+
+@pytest.fixture
+def stagefile(tmpdir):
+    f = tmpdir.join('echo.py')
+    f.write(handler_content('echo', ['in'], ['out']).replace(
+        '#!/usr/bin/env python', '#!%s' % sys.executable
+    ))
+    return f
+
+
+def communicate(process, data=b''):
+    "Popen.communicate for small amounts of output, which is all we need"
+    process.stdin.write(data)
+    process.stdin.close()
+    out, err = process.stdout.read(), process.stderr.read()
+    process.wait()
+    return out, err
+
+
+class TestInterpreter(object):
+    @pytest.mark.parametrize('runner,expected', [
+        ('python', 'python'),
+        ('/usr/bin/python3.11', '/usr/bin/python3.11'),
+        ('/usr/bin/env python3', 'python3'),
+        ('python -u', None),
+        ('ruby', None),
+        ('bash', None),
+    ])
+    def test_interpreter(self, runner, expected):
+        assert zygote.interpreter(runner) == expected
+
+
+class TestZygote(object):
+    def test_run(self, zygotes, stagefile):
+        stage = Stage(stagefile, zygotes=zygotes)
+
+        assert stage.configuration['name'] == 'echo'
+        assert zygotes.zygotes
+
+    def test_process(self, zygotes, stagefile):
+        out = Stage(stagefile, zygotes=zygotes).process([{'n': 1}, {'n': 2}])
+
+        assert [o['n'] for o in out] == [1, 2]
+        assert out[0]['pid'] != os.getpid()
+
+    def test_forks_from_one_interpreter(self, zygotes, stagefile):
+        stage = Stage(stagefile, zygotes=zygotes)
+        stage.request('process', [{}])
+        stage.request('process', [{}])
+
+        assert len(zygotes.zygotes) == 1
+
+    def test_exit_code(self, zygotes, stagefile):
+        process = zygotes.spawn(sys.executable, [str(stagefile), 'process'])
+        communicate(process, b'{"exit": 3}\n')
+
+        assert process.returncode == 3
+
+    def test_kill(self, zygotes, tmpdir):
+        f = tmpdir.join('sleep.py')
+        f.write('import time\ntime.sleep(30)\n')
+        process = zygotes.spawn(sys.executable, [str(f)])
+        assert process.poll() is None
+
+        process.kill()
+        assert process.wait() == -9
+
+    def test_environment(self, zygotes, tmpdir):
+        f = tmpdir.join('env.py')
+        f.write('import os, sys\nsys.stdout.write(os.environ["ZYGOTE_TEST"])\n')
+        env = dict(os.environ, ZYGOTE_TEST='yes')
+        process = zygotes.spawn(sys.executable, [str(f)], env)
+
+        assert communicate(process)[0] == b'yes'
+
+    def test_imports_next_to_the_script(self, zygotes, tmpdir):
+        stages = tmpdir.join('stages')
+        stages.join('helper.py').write('VALUE = "helper"\n', ensure=True)
+        f = stages.join('uses.py')
+        f.write('import sys, helper\nsys.stdout.write(sys.path[0] + helper.VALUE)\n')
+        process = zygotes.spawn(sys.executable, [str(f)])
+
+        assert communicate(process)[0] == (str(stages) + 'helper').encode('utf-8')
+
+    def test_falls_back_without_perch(self, tmpdir, monkeypatch):
+        "an interpreter that can't import perch runs its stages the usual way"
+        monkeypatch.chdir(tmpdir)
+        monkeypatch.delenv('PYTHONPATH', raising=False)
+        f = tmpdir.join('plain.py')
+        f.write(dedent("""
+            #!%s
+            import json, os, sys
+            if sys.argv[1] == 'config':
+                json.dump({'name': 'plain', 'input_tags': [],
+                           'output_tags': [], 'persistent': False}, sys.stdout)
+            else:
+                for line in sys.stdin:
+                    obj = json.loads(line)
+                    obj['pid'] = os.getpid()
+                    sys.stdout.write(json.dumps(obj) + '\\n')
+        """ % sys.executable).strip())
+        pool = zygote.Zygotes()
+        try:
+            out = Stage(f, zygotes=pool).process([{'n': 1}])
+            assert out[0]['n'] == 1
+            assert not pool.fits(sys.executable)
+        finally:
+            pool.close()
+
+    def test_persistent(self, zygotes, stagefile):
+        stage = Stage(stagefile, persistent=True, zygotes=zygotes)
+        try:
+            first = stage.request('process', [{}])
+            second = stage.request('process', [{}])
+        finally:
+            stage.close()
+
+        assert first[0]['pid'] == second[0]['pid']
+
+    def test_preload(self, importable, tmpdir):
+        f = tmpdir.join('check.py')
+        f.write('import sys\nsys.stdout.write(str("json.decoder" in sys.modules))\n')
+        pool = zygote.Zygotes(['json'])
+        try:
+            process = pool.spawn(sys.executable, [str(f)])
+            assert communicate(process)[0] == b'True'
+        finally:
+            pool.close()